@@ -4,21 +4,31 @@
 
 import abc
 import argparse
+import bisect
+from collections import OrderedDict
+import concurrent.futures
+import ctypes
+import ctypes.util
 import errno
-import functools
-import io
+import hashlib
+import heapq
+import mmap
 import os
 from pathlib import PurePosixPath as PPPath
 import sarc
+import select
 import shutil
+import sqlite3
 import stat
+import struct
 import sys
+import syaz0
 import threading
+import time
 import typing
 
-from fuse import FUSE, FuseOSError, Operations # type: ignore
-
-BINARY_MODE = os.O_BINARY if os.name == 'nt' else 0
+from botwfstools.fsutil import (BINARY_MODE, COPY_CHUNK_SIZE, FUSE, FuseOSError, Operations, Profiler,
+                                TraceRecorder, copy_file_data, install_profile_signal, my_stat, pack_str)
 
 ARCHIVE_EXTS = {'sarc', 'pack', 'bactorpack', 'bmodelsh', 'beventpack', 'stera', 'stats',
                 'ssarc', 'spack', 'sbactorpack', 'sbmodelsh', 'sbeventpack', 'sstera', 'sstats',
@@ -28,54 +38,80 @@ def is_archive_filename(path: PPPath) -> bool:
     return path.suffix[1:] in ARCHIVE_EXTS
 
 class File(metaclass=abc.ABCMeta):
+    """A file that is read and written at explicit offsets, so that it can be used from several threads."""
     __slots__ = ()
     @abc.abstractclassmethod
-    def read(self, length: int) -> bytes:
-        pass
-    @abc.abstractclassmethod
-    def write(self, buffer) -> int:
+    def pread(self, count: int, offset: int) -> bytes:
         pass
     @abc.abstractclassmethod
-    def seek(self, offset: int) -> int:
+    def pwrite(self, data, offset: int) -> int:
         pass
     @abc.abstractclassmethod
     def get_size(self) -> int:
         pass
+    def get_data(self) -> memoryview:
+        """Returns the entire contents of the file."""
+        return memoryview(self.pread(self.get_size(), 0))
+    def copy_to(self, fd: int) -> None:
+        """Writes the entire contents of the file to an empty host file."""
+        data = self.get_data()
+        while data:
+            data = data[os.write(fd, data[:COPY_CHUNK_SIZE]):]
 
 class HostFile(File):
-    __slots__ = ('_fh')
+    __slots__ = ('_fh', '_lock')
     def __init__(self, fh) -> None:
         self._fh = fh
+        if not hasattr(os, 'pread'):
+            self._lock = threading.Lock()
     def __del__(self) -> None:
         os.close(self._fh)
-    def read(self, count: int) -> bytes:
-        return os.read(self._fh, count)
-    def write(self, data) -> int:
-        return os.write(self._fh, data)
-    def seek(self, offset: int) -> int:
-        return os.lseek(self._fh, offset, os.SEEK_SET)
+    if hasattr(os, 'pread'):
+        def pread(self, count: int, offset: int) -> bytes:
+            return os.pread(self._fh, count, offset)
+        def pwrite(self, data, offset: int) -> int:
+            return os.pwrite(self._fh, data, offset)
+    else:
+        # Windows does not have pread/pwrite.
+        def pread(self, count: int, offset: int) -> bytes:
+            with self._lock:
+                os.lseek(self._fh, offset, os.SEEK_SET)
+                return os.read(self._fh, count)
+        def pwrite(self, data, offset: int) -> int:
+            with self._lock:
+                os.lseek(self._fh, offset, os.SEEK_SET)
+                return os.write(self._fh, data)
     def get_size(self) -> int:
         return os.fstat(self._fh).st_size
+    def copy_to(self, fd: int) -> None:
+        copy_file_data(self._fh, fd)
 
 class InMemoryFile(File):
-    __slots__ = ('_data', '_position')
+    __slots__ = ('_data')
     def __init__(self, data: memoryview) -> None:
         self._data = data
-        self._position = 0
-    def read(self, count: int) -> bytes:
-        actual_count = count
-        if self._position + count > len(self._data):
-            actual_count = len(self._data) - self._position
-        if actual_count <= 0:
-            return bytes()
-        return self._data[self._position:self._position + actual_count].tobytes()
-    def write(self, data) -> int:
+    def pread(self, count: int, offset: int) -> bytes:
+        return self._data[offset:offset + count].tobytes()
+    def pwrite(self, data, offset: int) -> int:
         raise FuseOSError(errno.EROFS)
-    def seek(self, offset: int) -> int:
-        self._position = offset
-        return offset
     def get_size(self) -> int:
         return len(self._data)
+    def get_data(self) -> memoryview:
+        return self._data
+
+class ControlFile(File):
+    """Virtual file that shows a status and passes anything that is written to it to a function."""
+    __slots__ = ('_get_status', '_on_write')
+    def __init__(self, get_status: typing.Callable[[], bytes], on_write: typing.Callable[[bytes], None]) -> None:
+        self._get_status = get_status
+        self._on_write = on_write
+    def pread(self, count: int, offset: int) -> bytes:
+        return self._get_status()[offset:offset + count]
+    def pwrite(self, data, offset: int) -> int:
+        self._on_write(bytes(data))
+        return len(data)
+    def get_size(self) -> int:
+        return len(self._get_status())
 
 class Directory(metaclass=abc.ABCMeta):
     __slots__ = ('_path', '_base_path')
@@ -93,15 +129,21 @@ class Directory(metaclass=abc.ABCMeta):
     @abc.abstractclassmethod
     def get_file_stats(self, path: PPPath) -> dict:
         pass
+    @abc.abstractclassmethod
+    def get_source_key(self, path: PPPath) -> str:
+        """Returns a string that identifies where the data for a file comes from."""
+        pass
+    def list_files_with_stats(self, path: PPPath) -> typing.List[typing.Tuple[str, dict]]:
+        """Returns the name and stats of every entry in a directory."""
+        entries = []
+        for name in self.list_files(path):
+            try:
+                entries.append((name, self.get_file_stats(path / name)))
+            except (FuseOSError, OSError):
+                pass
+        return entries
 
 # To work around a stupid readonly attribute limitation.
-def my_stat(st) -> dict:
-    d = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-             'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-    if os.name != 'nt':
-        d['st_blocks'] = st.st_blocks
-    return d
-
 def change_st_to_directory(st) -> None:
     st['st_mode'] &= ~stat.S_IFREG
     st['st_mode'] |= stat.S_IFDIR
@@ -116,91 +158,1018 @@ class HostDirectory(Directory):
     def list_files(self, path: PPPath) -> typing.Collection[str]:
         return os.listdir(self._path / path)
 
+    def list_files_with_stats(self, path: PPPath) -> typing.List[typing.Tuple[str, dict]]:
+        with os.scandir(str(self._path / path)) as it:
+            return [(entry.name, my_stat(entry.stat(follow_symlinks=False))) for entry in it]
+
     def open_file(self, file: PPPath, flags) -> File:
         return HostFile(os.open(self._path / file, flags | BINARY_MODE))
 
     def get_file_stats(self, path: PPPath) -> dict:
         return my_stat(os.lstat(self._path / path))
 
+    def get_source_key(self, path: PPPath) -> str:
+        return str(self._path / path)
+
+class _SARC(sarc.SARC):
+    """SARC that can be backed by a slice of a larger buffer (e.g. a nested archive)."""
+    def _read_string(self, offset: int) -> str:
+        # The base implementation searches the buffer's underlying object, which is only
+        # correct if the view starts at the beginning of that object.
+        end = offset
+        while True:
+            chunk = self._data[end:end + 0x100].tobytes()
+            nul_position = chunk.find(b'\x00')
+            if nul_position != -1:
+                end += nul_position
+                break
+            if not chunk:
+                break
+            end += len(chunk)
+        return self._data[offset:end].tobytes().decode()
+
+class Yaz0Decoder:
+    """Incremental Yaz0 decoder, for when only the beginning of the decompressed data is needed.
+    This is much slower than syaz0 per byte, so it should only be used to decode small parts."""
+    # Rough number of times syaz0 is faster per decompressed byte.
+    SLOWDOWN = 100
+    __slots__ = ('_src', '_src_pos', '_group', '_group_bits', 'output', 'output_offset')
+
+    def __init__(self, src, src_pos: int = 0x10, window: bytes = b'', output_offset: int = 0) -> None:
+        """To resume decoding at a group boundary, pass the compressed data from that point on,
+        the data that was decompressed just before it (window) and the decompressed offset of the window."""
+        self._src = src
+        self._src_pos = src_pos
+        self._group = 0
+        self._group_bits = 0
+        self.output = bytearray(window)
+        # Decompressed offset of the first byte in output.
+        self.output_offset = output_offset
+
+    @staticmethod
+    def get_uncompressed_size(src) -> int:
+        return struct.unpack_from('>I', src, 4)[0]
+
+    def extend_input(self, data) -> None:
+        """Appends compressed data that follows the data the decoder was created with."""
+        self._src = bytes(self._src) + bytes(data)
+
+    def decode(self, size: int) -> None:
+        """Decodes until at least size bytes of output are available (or the data ends)."""
+        src = self._src
+        src_pos = self._src_pos
+        out = self.output
+        group = self._group
+        group_bits = self._group_bits
+        src_size = len(src)
+        try:
+            while len(out) < size:
+                if group_bits == 0:
+                    if src_pos >= src_size:
+                        break
+                    group = src[src_pos]
+                    src_pos += 1
+                    group_bits = 8
+                group_bits -= 1
+                if group & (1 << group_bits):
+                    out.append(src[src_pos])
+                    src_pos += 1
+                    continue
+                b1 = src[src_pos]
+                b2 = src[src_pos + 1]
+                src_pos += 2
+                distance = ((b1 & 0xf) << 8 | b2) + 1
+                count = b1 >> 4
+                if count == 0:
+                    count = src[src_pos] + 0x12
+                    src_pos += 1
+                else:
+                    count += 2
+                start = len(out) - distance
+                if start < 0:
+                    raise ValueError('Invalid Yaz0 back-reference')
+                if distance >= count:
+                    out += out[start:start + count]
+                else:
+                    for i in range(count):
+                        out.append(out[start + i])
+        except IndexError:
+            raise ValueError('Truncated Yaz0 data')
+        self._src_pos = src_pos
+        self._group = group
+        self._group_bits = group_bits
+
+class Yaz0CheckpointIndex:
+    """Positions in a Yaz0 stream from which decoding can start without decoding everything before."""
+    INTERVAL = 128 * 1024
+    # Smaller archives are decompressed quickly enough by syaz0.
+    MIN_DATA_SIZE = 16 * 1024 * 1024
+    WINDOW_SIZE = 0x1000
+    _HEADER = struct.Struct('<4sII')
+    _ENTRY = struct.Struct('<QQ')
+    _MAGIC = b'Y0CI'
+
+    def __init__(self, checkpoints: typing.List[typing.Tuple[int, int, bytes]]) -> None:
+        # (compressed offset, decompressed offset, window), sorted by offset.
+        self.checkpoints = checkpoints
+        self._output_offsets = [checkpoint[1] for checkpoint in checkpoints]
+
+    @staticmethod
+    def build(src, data, interval: int = INTERVAL) -> 'Yaz0CheckpointIndex':
+        """Builds an index from compressed data and the result of decompressing it."""
+        checkpoints: typing.List[typing.Tuple[int, int, bytes]] = [(0x10, 0, b'')]
+        src_pos = 0x10
+        out_pos = 0
+        next_checkpoint = interval
+        size = len(data)
+        while out_pos < size:
+            # Checkpoints are always at group boundaries so that no group state has to be stored.
+            if out_pos >= next_checkpoint:
+                window = bytes(data[max(0, out_pos - Yaz0CheckpointIndex.WINDOW_SIZE):out_pos])
+                checkpoints.append((src_pos, out_pos, window))
+                next_checkpoint = out_pos + interval
+            group = src[src_pos]
+            src_pos += 1
+            for bit in range(7, -1, -1):
+                if out_pos >= size:
+                    break
+                if group & (1 << bit):
+                    out_pos += 1
+                    src_pos += 1
+                    continue
+                count = src[src_pos] >> 4
+                src_pos += 2
+                if count == 0:
+                    count = src[src_pos] + 0x12
+                    src_pos += 1
+                else:
+                    count += 2
+                out_pos += count
+        return Yaz0CheckpointIndex(checkpoints)
+
+    def find(self, offset: int) -> typing.Tuple[int, int, bytes]:
+        """Returns the last checkpoint at or before a decompressed offset."""
+        return self.checkpoints[bisect.bisect_right(self._output_offsets, offset) - 1]
+
+    def to_bytes(self) -> bytes:
+        parts = [self._HEADER.pack(self._MAGIC, 1, len(self.checkpoints))]
+        for src_pos, out_pos, window in self.checkpoints:
+            parts.append(self._ENTRY.pack(src_pos, out_pos))
+            parts.append(window)
+        return b''.join(parts)
+
+    @staticmethod
+    def from_bytes(data) -> 'Yaz0CheckpointIndex':
+        magic, version, count = Yaz0CheckpointIndex._HEADER.unpack_from(data, 0)
+        if magic != Yaz0CheckpointIndex._MAGIC or version != 1:
+            raise ValueError('Invalid Yaz0 checkpoint index')
+        offset = Yaz0CheckpointIndex._HEADER.size
+        checkpoints = []
+        for _ in range(count):
+            src_pos, out_pos = Yaz0CheckpointIndex._ENTRY.unpack_from(data, offset)
+            offset += Yaz0CheckpointIndex._ENTRY.size
+            window_size = min(out_pos, Yaz0CheckpointIndex.WINDOW_SIZE)
+            checkpoints.append((src_pos, out_pos, bytes(data[offset:offset + window_size])))
+            offset += window_size
+        return Yaz0CheckpointIndex(checkpoints)
+
+def _max_yaz0_input_size(output_size: int) -> int:
+    # Worst case: every byte is a literal, which costs 9 bits.
+    return 0x10 + output_size + (output_size + 7) // 8
+
+def read_yaz0_range(file: File, checkpoints: Yaz0CheckpointIndex, offset: int, size: int) -> memoryview:
+    """Decompresses size bytes at a decompressed offset, starting from the nearest checkpoint."""
+    src_pos, out_pos, window = checkpoints.find(offset)
+    output_size = offset + size - out_pos
+    decoder = Yaz0Decoder(file.pread(_max_yaz0_input_size(output_size), src_pos), 0,
+                          window, out_pos - len(window))
+    decoder.decode(offset + size - decoder.output_offset)
+    start = offset - decoder.output_offset
+    return memoryview(bytes(decoder.output[start:start + size]))
+
+def read_sarc_header(file: File) -> typing.Tuple[typing.Optional[memoryview], bool]:
+    """Returns the decompressed beginning of an archive up to the end of its name table,
+    which is all that is needed to list the archive, and whether the archive is compressed.
+    Compressed archives are only partially decompressed."""
+    data = file.pread(_max_yaz0_input_size(0x14), 0)
+    if data[0:4] == b'Yaz0':
+        decoder = Yaz0Decoder(data)
+        decoder.decode(0x14)
+        header = decoder.output
+        if header[0:4] != b'SARC':
+            return (None, True)
+        data_offset = struct.unpack_from('>I' if header[6:8] == b'\xfe\xff' else '<I', header, 0xc)[0]
+        # The decoder only has the input it needed for the header so far.
+        decoder.extend_input(file.pread(max(0, _max_yaz0_input_size(data_offset) - len(data)), len(data)))
+        decoder.decode(data_offset)
+        return (memoryview(bytes(decoder.output[:data_offset])), True)
+    if data[0:4] == b'SARC':
+        data_offset = struct.unpack_from('>I' if data[6:8] == b'\xfe\xff' else '<I', data, 0xc)[0]
+        if isinstance(file, InMemoryFile):
+            return (file.get_data()[:data_offset], False)
+        return (memoryview(file.pread(data_offset, 0)), False)
+    return (None, False)
+
+def make_sarc(data: memoryview) -> typing.Optional[sarc.SARC]:
+    """Makes a SARC without copying the data unless it is Yaz0 compressed."""
+    magic = data[0:4]
+    if magic == b'Yaz0':
+        if data[0x11:0x15] != b'SARC':
+            return None
+        return _SARC(syaz0.decompress(data))
+    if magic == b'SARC':
+        return _SARC(data)
+    return None
+
+class ArchiveIndex:
+    """Directory tree of a SARC, built once so that listing and stat do not need to scan every entry."""
+    __slots__ = ('dirs', 'files')
+
+    def __init__(self, entries: typing.Iterable[typing.Tuple[str, int, int]]) -> None:
+        # Directory path ('' for the root) -> names of its children.
+        self.dirs: typing.Dict[str, typing.Set[str]] = {'': set()}
+        # Member path (without any leading slash) -> (name in the archive, size, offset in the archive).
+        self.files: typing.Dict[str, typing.Tuple[str, int, int]] = dict()
+        for name, size, offset in entries:
+            # Strip leading slashes. These cannot be used in file names.
+            path = name[1:] if name[0] == '/' else name
+            self.files[path] = (name, size, offset)
+            parent, _, base = path.rpartition('/')
+            while True:
+                children = self.dirs.get(parent)
+                if children is not None:
+                    children.add(base)
+                    break
+                self.dirs[parent] = {base}
+                parent, _, base = parent.rpartition('/')
+
+    @staticmethod
+    def from_sarc(archive: sarc.SARC) -> 'ArchiveIndex':
+        data_offset = archive.get_data_offset()
+        return ArchiveIndex((name, archive.get_file_size(name), data_offset + archive.get_file_data_offset(name))
+                            for name in archive.list_files())
+
 class ArchiveDirectory(Directory):
-    __slots__ = ('_arc', '_parent')
+    __slots__ = ('_read_member', '_index', '_parent')
     SELF_FILE_NAME = '.__RAW_ARCHIVE__'
 
-    def __init__(self, base_path: PPPath, path: PPPath, archive: sarc.SARC, parent: Directory) -> None:
+    def __init__(self, base_path: PPPath, path: PPPath, read_member: typing.Callable[[str, int, int], memoryview],
+                 index: ArchiveIndex, parent: Directory) -> None:
         super().__init__(base_path, path)
-        self._arc = archive
+        # Called with an index entry (name, size, offset) to get the data of a member. The archive data
+        # is only loaded (and decompressed) when a file is opened.
+        self._read_member = read_member
+        self._index = index
         self._parent = parent
 
     def list_files(self, path: PPPath) -> typing.Collection[str]:
-        names: typing.Set[str] = set()
-        directory = str(path) + '/' if str(path) != '.' else ''
-        for name in self._arc.list_files():
-            if directory and not name.startswith(directory):
-                continue
-            # Strip leading slashes. These cannot be used in file names.
-            if name[0] == '/':
-                name = name[1:]
-            name = name[len(directory):]
-            slash_position = name.find('/')
-            if slash_position != -1:
-                names.add(name[:slash_position])
-            else:
-                names.add(name)
+        directory = str(path) if str(path) != '.' else ''
+        names = self._index.dirs.get(directory)
+        if names is None:
+            return set()
         if directory == '':
-            names.add(ArchiveDirectory.SELF_FILE_NAME)
-        return names
+            return names | {ArchiveDirectory.SELF_FILE_NAME}
+        return set(names)
 
     def open_file(self, file: PPPath, flags) -> File:
         if str(file) == ArchiveDirectory.SELF_FILE_NAME:
             return self._parent.open_file(self._path.relative_to(self._parent._path), os.O_RDONLY)
-        try:
-            return InMemoryFile(self._arc.get_file_data(str(file)))
-        except KeyError:
-            # Some archives have leading slashes.
-            return InMemoryFile(self._arc.get_file_data('/' + str(file)))
+        entry = self._index.files.get(str(file))
+        if entry is None:
+            raise FuseOSError(errno.ENOENT)
+        return InMemoryFile(self._read_member(*entry))
+
     def get_file_stats(self, path: PPPath) -> dict:
         # Use the SARC's stats to get correct-ish timestamps and other metadata easily.
         arc_stat = self._parent.get_file_stats(self._path.relative_to(self._parent._path))
         if str(path) == ArchiveDirectory.SELF_FILE_NAME:
             return arc_stat
 
-        for arc_file in self._arc.list_files():
-            if arc_file == str(path) or arc_file == '/' + str(path):
-                arc_stat['st_mode'] &= ~stat.S_IFDIR
-                arc_stat['st_mode'] &= ~stat.S_IXUSR
-                arc_stat['st_mode'] |= stat.S_IFREG
-                arc_stat['st_mode'] |= stat.S_IRUSR | stat.S_IWUSR
-                arc_stat['st_size'] = self._arc.get_file_size(arc_file)
-                return arc_stat
+        entry = self._index.files.get(str(path))
+        if entry is not None:
+            arc_stat['st_mode'] &= ~stat.S_IFDIR
+            arc_stat['st_mode'] &= ~stat.S_IXUSR
+            arc_stat['st_mode'] |= stat.S_IFREG
+            arc_stat['st_mode'] |= stat.S_IRUSR | stat.S_IWUSR
+            arc_stat['st_size'] = entry[1]
+            return arc_stat
 
-            if str(path) + '/' in arc_file:
-                change_st_to_directory(arc_stat)
-                return arc_stat
+        if str(path) in self._index.dirs:
+            change_st_to_directory(arc_stat)
+            return arc_stat
 
         raise FuseOSError(errno.ENOENT)
 
+    def list_files_with_stats(self, path: PPPath) -> typing.List[typing.Tuple[str, dict]]:
+        directory = str(path) if str(path) != '.' else ''
+        names = self._index.dirs.get(directory)
+        if names is None:
+            return []
+        # All entries are derived from the archive's stats, so the parent only needs to be asked once.
+        arc_stat = self._parent.get_file_stats(self._path.relative_to(self._parent._path))
+        file_stat = dict(arc_stat)
+        file_stat['st_mode'] &= ~(stat.S_IFDIR | stat.S_IXUSR)
+        file_stat['st_mode'] |= stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR
+        dir_stat = dict(arc_stat)
+        change_st_to_directory(dir_stat)
+        entries = []
+        for name in names:
+            entry = self._index.files.get(directory + '/' + name if directory else name)
+            if entry is not None:
+                st = dict(file_stat)
+                st['st_size'] = entry[1]
+            else:
+                st = dict(dir_stat)
+            entries.append((name, st))
+        if directory == '':
+            entries.append((ArchiveDirectory.SELF_FILE_NAME, arc_stat))
+        return entries
+
+    def get_source_key(self, path: PPPath) -> str:
+        return self._parent.get_source_key(self._path.relative_to(self._parent._path)) + '//' + str(path)
+
+def make_archive_key(source_key: str, st: dict) -> str:
+    """Returns a key that identifies the contents of an archive, from its source key (which includes
+    the nesting chain) and its stats (which include the size and mtime of the host file)."""
+    return hashlib.sha1(('%s:%d:%r' % (source_key, st['st_size'], st['st_mtime'])).encode()).hexdigest()
+
+class DecompressedArchiveCache:
+    """On-disk cache of decompressed archives and Yaz0 checkpoint indexes. Entries are evicted
+    in LRU order once the cache grows larger than max_size bytes. Checkpoint indexes are only useful
+    once the decompressed archive is gone, so they are used along with it and evicted after it."""
+    SUFFIX = '.sarc'
+    CHECKPOINTS_SUFFIX = '.y0ci'
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self._dir = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Left over from writes that were interrupted by a crash. They are not counted as entries.
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except OSError:
+                    pass
+        self._size = sum(os.path.getsize(path) for path in self._list_entries())
+
+    def _list_entries(self) -> typing.List[str]:
+        return [os.path.join(self._dir, name) for name in os.listdir(self._dir)
+                if name.endswith(self.SUFFIX) or name.endswith(self.CHECKPOINTS_SUFFIX)]
+
+    def has(self, key: str, suffix: str = SUFFIX) -> bool:
+        return os.path.exists(os.path.join(self._dir, key + suffix))
+
+    def get(self, key: str, suffix: str = SUFFIX) -> typing.Optional[memoryview]:
+        path = os.path.join(self._dir, key + suffix)
+        try:
+            fd = os.open(path, os.O_RDONLY | BINARY_MODE)
+        except FileNotFoundError:
+            return None
+        try:
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        # Update the modification time to keep track of recently used entries.
+        os.utime(path)
+        if suffix == self.SUFFIX:
+            try:
+                os.utime(os.path.join(self._dir, key + self.CHECKPOINTS_SUFFIX))
+            except FileNotFoundError:
+                pass
+        return memoryview(data)
+
+    def put(self, key: str, data, suffix: str = SUFFIX) -> None:
+        path = os.path.join(self._dir, key + suffix)
+        if len(data) > self._max_size:
+            return
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._size += len(data)
+            if self._size > self._max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self._list_entries():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, path.endswith(self.CHECKPOINTS_SUFFIX), st.st_size, path))
+        entries.sort()
+        self._size = sum(entry[2] for entry in entries)
+        for _, _, size, path in entries:
+            if self._size <= self._max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # The file may still be mapped (Windows).
+                continue
+            self._size -= size
+
+class ArchiveCatalog:
+    """Persistent table of contents for archives, so that they can be listed without being read."""
+    def __init__(self, file_path: str) -> None:
+        self._db = sqlite3.connect(file_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS archives (key TEXT PRIMARY KEY, source TEXT NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS archives_source ON archives (source)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS members (archive_key TEXT NOT NULL, name TEXT NOT NULL, '
+                             'offset INTEGER NOT NULL, size INTEGER NOT NULL, alignment INTEGER NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS members_archive_key ON members (archive_key)')
+
+    def has(self, key: str) -> bool:
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM archives WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key: str) -> typing.Optional[typing.List[typing.Tuple[str, int, int]]]:
+        """Returns (name, size, offset) for every member of the archive, or None if it is not in the catalog."""
+        with self._lock:
+            if not self._db.execute('SELECT 1 FROM archives WHERE key = ?', (key,)).fetchone():
+                return None
+            return self._db.execute('SELECT name, size, offset FROM members WHERE archive_key = ?', (key,)).fetchall()
+
+    def put(self, key: str, source_key: str, index: ArchiveIndex) -> None:
+        with self._lock, self._db:
+            # Older versions of the same archive will never be used again.
+            old_keys = self._db.execute('SELECT key FROM archives WHERE source = ?', (source_key,)).fetchall()
+            self._db.executemany('DELETE FROM members WHERE archive_key = ?', old_keys)
+            self._db.execute('DELETE FROM archives WHERE source = ?', (source_key,))
+            self._db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?)', (key, source_key))
+            self._db.executemany('INSERT INTO members VALUES (?, ?, ?, ?, ?)',
+                                 ((key, name, offset, size, min(offset & -offset, 0x2000) if offset else 0x2000)
+                                  for name, size, offset in index.files.values()))
+
+    def remove(self, key: str) -> None:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM members WHERE archive_key = ?', (key,))
+            self._db.execute('DELETE FROM archives WHERE key = ?', (key,))
+
+class AccessProfile:
+    """Order in which archives were first read in previous sessions, used to prefetch archives before
+    they are needed, and the order in which they are read in this session."""
+    MAX_ENTRIES = 4096
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.previous: typing.List[str] = []
+        try:
+            with open(file_path, 'r') as f:
+                self.previous = [line.rstrip('\n') for line in f if line.strip()]
+        except OSError:
+            pass
+        self._positions = {path: i for i, path in reversed(list(enumerate(self.previous)))}
+        self._order: typing.List[str] = []
+        self._seen: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        # Entries of the previous order up to this position have already been returned by take_upcoming.
+        self._scheduled_until = 0
+
+    def record(self, path: str) -> typing.Optional[int]:
+        """Records an access. Returns the position of the path in the previous order if it is the first
+        access to it in this session and it was accessed in a previous session."""
+        with self._lock:
+            if path in self._seen:
+                return None
+            self._seen.add(path)
+            self._order.append(path)
+            return self._positions.get(path)
+
+    def take_upcoming(self, position: int, count: int) -> typing.List[str]:
+        """Returns the entries of the previous order up to position + count that have not been returned yet."""
+        with self._lock:
+            start = max(position, self._scheduled_until)
+            end = min(position + count, len(self.previous))
+            self._scheduled_until = max(self._scheduled_until, end)
+            return [path for path in self.previous[start:end] if path not in self._seen]
+
+    def save(self) -> None:
+        with self._lock:
+            seen = set(self._order)
+            order = self._order + [path for path in self.previous if path not in seen]
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.writelines(path + '\n' for path in order[:AccessProfile.MAX_ENTRIES])
+        os.replace(temp_path, self.file_path)
+
+K = typing.TypeVar('K')
+V = typing.TypeVar('V')
+class _PendingLoad:
+    __slots__ = ('done', 'value', 'error', 'invalidated')
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value: typing.Any = None
+        self.error: typing.Optional[BaseException] = None
+        self.invalidated = False
+
+class ArchiveCache(typing.Generic[K, V]):
+    """In-memory LRU cache for loaded archives that is bounded by the total size of the archives.
+    Pinned entries are never evicted and do not count towards the limit.
+    Concurrent requests for an entry that is being loaded wait for that load instead of starting another one."""
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._entries: typing.Dict[K, typing.Tuple[V, int]] = OrderedDict()
+        self._pinned: typing.Dict[K, typing.Tuple[V, int]] = dict()
+        self._loading: typing.Dict[K, _PendingLoad] = dict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.pinned_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.waits = 0
+
+    def peek(self, key: K) -> typing.Optional[V]:
+        """Returns the cached value for key without loading it or updating statistics."""
+        with self._lock:
+            entry = self._pinned.get(key) or self._entries.get(key)
+            return entry[0] if entry else None
+
+    def is_full(self) -> bool:
+        return self.size >= self._max_size
+
+    def has_room(self, size: int) -> bool:
+        """Returns whether an entry of this size can be added without evicting anything."""
+        return self.size + size <= self._max_size
+
+    def get(self, key: K, loader: typing.Callable[[], typing.Tuple[V, int]], pin: bool = False) -> V:
+        """Returns the cached value for key, or calls loader to get the value and its size in bytes."""
+        with self._lock:
+            entry = self._pinned.get(key)
+            if entry is None:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key) # type: ignore
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            pending = self._loading.get(key)
+            if pending is None:
+                self.misses += 1
+                pending = _PendingLoad()
+                self._loading[key] = pending
+                is_loader = True
+            else:
+                self.waits += 1
+                is_loader = False
+
+        if not is_loader:
+            pending.done.wait()
+            if pending.error:
+                raise pending.error
+            return pending.value
+
+        try:
+            value, size = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            pending.error = e
+            pending.done.set()
+            raise
+        with self._lock:
+            del self._loading[key]
+            pending.value = value
+            pending.done.set()
+            if pending.invalidated:
+                return value
+            if pin:
+                self._pinned[key] = (value, size)
+                self.pinned_size += size
+                return value
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self._max_size and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False) # type: ignore
+                self.size -= evicted_size
+                self.evictions += 1
+        return value
+
+    def remove_if(self, predicate: typing.Callable[[K], bool]) -> None:
+        with self._lock:
+            for entries in (self._entries, self._pinned):
+                for key in [key for key in entries if predicate(key)]:
+                    _, size = entries.pop(key)
+                    if entries is self._pinned:
+                        self.pinned_size -= size
+                    else:
+                        self.size -= size
+            # Results of loads that are still in progress may already be stale.
+            for key, pending in self._loading.items():
+                if predicate(key):
+                    pending.invalidated = True
+
+    def get_sizes(self) -> typing.List[typing.Tuple[K, int]]:
+        """Returns the key and size of every cached entry."""
+        with self._lock:
+            return [(key, size) for entries in (self._pinned, self._entries) for key, (_, size) in entries.items()]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'pinned_entries': len(self._pinned),
+                'size': self.size,
+                'pinned_size': self.pinned_size,
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'waits': self.waits,
+            }
+
+class OperationStats:
+    """Call counts and latency histograms for filesystem operations."""
+    # Upper bounds of the histogram buckets in microseconds. The last bucket has no bound.
+    BUCKETS = tuple(4**i for i in range(1, 11))
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Operation -> [count, total time, max time, count for each bucket...]
+        self._ops: typing.Dict[str, list] = dict()
+        self.bytes_decompressed = 0
+
+    def record(self, op: str, seconds: float) -> None:
+        bucket = bisect.bisect_left(OperationStats.BUCKETS, seconds * 1e6)
+        with self._lock:
+            entry = self._ops.get(op)
+            if entry is None:
+                entry = [0, 0.0, 0.0] + [0] * (len(OperationStats.BUCKETS) + 1)
+                self._ops[op] = entry
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3 + bucket] += 1
+
+    def add_decompressed(self, size: int) -> None:
+        with self._lock:
+            self.bytes_decompressed += size
+
+    def format(self) -> typing.List[str]:
+        """Returns one 'name value' line per statistic."""
+        lines = []
+        with self._lock:
+            for op, entry in sorted(self._ops.items()):
+                lines.append('op.%s.count %d' % (op, entry[0]))
+                lines.append('op.%s.total_us %d' % (op, entry[1] * 1e6))
+                lines.append('op.%s.max_us %d' % (op, entry[2] * 1e6))
+                # Cumulative, like Prometheus histograms.
+                total = 0
+                for bound, count in zip(OperationStats.BUCKETS, entry[3:]):
+                    total += count
+                    lines.append('op.%s.le_%dus %d' % (op, bound, total))
+                lines.append('op.%s.le_inf %d' % (op, entry[0]))
+            lines.append('bytes_decompressed %d' % self.bytes_decompressed)
+        return lines
+
+PROFILE_STAGES = {
+    'path resolution': ('_get_directory', '_get_parent_directory_from_partial', '_find_parent',
+                        '_do_find_parent', 'try_open_dir', 'isdir', 'lookup'),
+    'archive load': ('_load_sarc', '_load_archive_index', '_load_yaz0_checkpoints'),
+    'decompression': ('make_sarc', 'read_sarc_header', 'read_yaz0_range', 'decode'),
+    'stat': ('get_file_stats', 'list_files_with_stats', '<built-in method posix.lstat>',
+             '<built-in method posix.stat>', '<built-in method nt.lstat>', '<built-in method nt.stat>',
+             "<method 'stat' of 'posix.DirEntry' objects>", "<method 'stat' of 'nt.DirEntry' objects>"),
+}
+
+
 T = typing.TypeVar('T')
 class FdAllocator(typing.Generic[T]):
+    """Handle table. Freed handles are kept in a min-heap and the lowest one is reused first."""
     def __init__(self) -> None:
         self._fd_map: typing.Dict[int, T] = dict()
+        self._free_fds: typing.List[int] = []
         self._next_fd = 0
+        self.peak_count = 0
 
     def allocate(self, item: T) -> int:
-        fd = self._next_fd
-        while True:
-            if fd not in self._fd_map:
-                self._fd_map[fd] = item
-                self._next_fd = fd + 1
-                return fd
-            fd += 1
+        if self._free_fds:
+            fd = heapq.heappop(self._free_fds)
+        else:
+            fd = self._next_fd
+            self._next_fd += 1
+        self._fd_map[fd] = item
+        self.peak_count = max(self.peak_count, len(self._fd_map))
+        return fd
 
     def free(self, fd) -> None:
         del self._fd_map[fd]
-        self._next_fd = min(self._next_fd, fd)
+        heapq.heappush(self._free_fds, fd)
 
     def get_entry(self, fd) -> T:
         return self._fd_map[fd]
 
+    def __len__(self) -> int:
+        """Returns the number of live handles."""
+        return len(self._fd_map)
+
+class MetadataCache:
+    """LRU cache for host metadata (layer lookups, stats) that can be invalidated per path."""
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries: typing.Dict[PPPath, dict] = OrderedDict()
+        # Directory -> subpaths that are cached or have cached paths under them, so that a directory
+        # can be invalidated without going through every entry.
+        self._children: typing.Dict[PPPath, typing.Set[PPPath]] = dict()
+        self._lock = threading.Lock()
+        # Incremented on every invalidation so that values computed concurrently are not stored.
+        self._generation = 0
+
+    def _link(self, path: PPPath) -> None:
+        while path != path.parent:
+            siblings = self._children.get(path.parent)
+            if siblings is not None:
+                # The parent is already linked to its own parent.
+                siblings.add(path)
+                return
+            self._children[path.parent] = {path}
+            path = path.parent
+
+    def _unlink(self, path: PPPath) -> None:
+        """Removes a path that is no longer cached from the index, along with ancestors that are left empty."""
+        while path != path.parent and path not in self._children and path not in self._entries:
+            siblings = self._children.get(path.parent)
+            if siblings is None:
+                return
+            siblings.discard(path)
+            if siblings:
+                return
+            del self._children[path.parent]
+            path = path.parent
+
+    def _insert(self, path: PPPath) -> dict:
+        record = self._entries.get(path)
+        if record is None:
+            record = dict()
+            self._entries[path] = record
+            self._link(path)
+        return record
+
+    def _evict(self) -> None:
+        while len(self._entries) > self._max_entries:
+            path, _ = self._entries.popitem(last=False) # type: ignore
+            self._unlink(path)
+
+    def _remove(self, path: PPPath) -> None:
+        self._entries.pop(path, None)
+        self._unlink(path)
+
+    def get(self, path: PPPath, kind: str, fn: typing.Callable[[], typing.Any]) -> typing.Any:
+        with self._lock:
+            record = self._entries.get(path)
+            if record is not None and kind in record:
+                self._entries.move_to_end(path) # type: ignore
+                return record[kind]
+            generation = self._generation
+        value = fn()
+        with self._lock:
+            if generation != self._generation:
+                return value
+            self._insert(path)[kind] = value
+            self._evict()
+        return value
+
+    def has(self, path: PPPath, kind: str) -> bool:
+        with self._lock:
+            record = self._entries.get(path)
+            return record is not None and kind in record
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get_all(self, kind: str) -> typing.List[typing.Tuple[PPPath, typing.Any]]:
+        with self._lock:
+            return [(path, record[kind]) for path, record in self._entries.items() if kind in record]
+
+    def put_all(self, kind: str, items: typing.Iterable[typing.Tuple[PPPath, typing.Any]],
+                generation: typing.Optional[int] = None) -> None:
+        """Stores several values at once. If a generation is passed, nothing is stored if there
+        has been an invalidation since."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            for path, value in items:
+                self._insert(path)[kind] = value
+            self._evict()
+
+    def invalidate(self, path: typing.Optional[PPPath], is_dir: bool) -> None:
+        """Drops the entries for a path and its parent (whose timestamps change), and for
+        everything under the path if it is a directory. None drops everything."""
+        with self._lock:
+            self._generation += 1
+            if path is None:
+                self._entries.clear()
+                self._children.clear()
+                return
+            if is_dir:
+                pending = list(self._children.pop(path, ()))
+                while pending:
+                    subpath = pending.pop()
+                    self._entries.pop(subpath, None)
+                    pending.extend(self._children.pop(subpath, ()))
+            self._remove(path)
+            self._remove(path.parent)
+
+class LayerIndex:
+    """Merged index of all content layers: maps every relative path to the layers it comes from,
+    and every directory to the merged list of its entries."""
+    def __init__(self, dirs: typing.List[PPPath]) -> None:
+        self._dirs = dirs
+        # Relative path -> [last layer that has the path, last layer that has it as a file (or -1), is a directory in any layer]
+        self._entries: typing.Dict[PPPath, list] = dict()
+        self._children: typing.Dict[PPPath, typing.Set[str]] = dict()
+        self._lock = threading.Lock()
+        # Serialises updates, so that an older scan of a path is never applied after a newer one.
+        self._update_lock = threading.Lock()
+        # (layer, directory) -> mtime of the directory when it was scanned. Used to validate snapshots.
+        self._dir_mtimes: typing.Dict[typing.Tuple[int, PPPath], int] = dict()
+        # Paths that were changed while the index was being built.
+        self._pending_updates: typing.List[PPPath] = []
+        self.ready = False
+
+    def _scan_dir(self, layer: int, rel_path: PPPath) -> typing.Tuple[int, PPPath, typing.List[typing.Tuple[str, bool]]]:
+        host_path = str(self._dirs[layer] / rel_path)
+        try:
+            # Get the mtime first, so that changes made during the scan make the recorded mtime stale.
+            self._dir_mtimes[(layer, rel_path)] = os.stat(host_path).st_mtime_ns
+            with os.scandir(host_path) as it:
+                return (layer, rel_path, [(entry.name, entry.is_dir()) for entry in it])
+        except OSError:
+            return (layer, rel_path, [])
+
+    def build(self, jobs: int = 8) -> None:
+        """Walks all layers in parallel. Lookups fall back to probing the layers until this is done."""
+        scanned: typing.List[typing.Dict[PPPath, bool]] = [dict() for _ in self._dirs]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {executor.submit(self._scan_dir, layer, PPPath('.')) for layer in range(len(self._dirs))}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    layer, rel_path, dir_entries = future.result()
+                    for name, is_dir in dir_entries:
+                        scanned[layer][rel_path / name] = is_dir
+                        if is_dir:
+                            pending.add(executor.submit(self._scan_dir, layer, rel_path / name))
+
+        with self._lock:
+            self._add(PPPath('.'), len(self._dirs) - 1, True)
+            for layer, paths in enumerate(scanned):
+                for rel_path, is_dir in paths.items():
+                    self._add(rel_path, layer, is_dir)
+            self.ready = True
+            for rel_path in self._pending_updates:
+                self._update(rel_path)
+            self._pending_updates = []
+
+    @staticmethod
+    def _add_to(entries: typing.Dict[PPPath, list], children: typing.Dict[PPPath, typing.Set[str]],
+                rel_path: PPPath, layer: int, is_dir: bool) -> None:
+        entry = entries.get(rel_path)
+        if entry is None:
+            entries[rel_path] = [layer, -1 if is_dir else layer, is_dir]
+            if rel_path != PPPath('.'):
+                children.setdefault(rel_path.parent, set()).add(rel_path.name)
+        else:
+            entry[0] = max(entry[0], layer)
+            if not is_dir:
+                entry[1] = max(entry[1], layer)
+            entry[2] = entry[2] or is_dir
+        if is_dir:
+            children.setdefault(rel_path, set())
+
+    def _add(self, rel_path: PPPath, layer: int, is_dir: bool) -> None:
+        self._add_to(self._entries, self._children, rel_path, layer, is_dir)
+
+    def _scan_tree(self, rel_path: PPPath) -> tuple:
+        """Walks a path in every layer. Returns the entries, children and directory mtimes for it
+        without touching the index."""
+        entries: typing.Dict[PPPath, list] = dict()
+        children: typing.Dict[PPPath, typing.Set[str]] = dict()
+        dir_mtimes: typing.Dict[typing.Tuple[int, PPPath], int] = dict()
+        for layer, d in enumerate(self._dirs):
+            host_path = str(d / rel_path)
+            if os.path.isdir(host_path):
+                self._add_to(entries, children, rel_path, layer, True)
+                for dir_path, dir_names, file_names in os.walk(host_path):
+                    dir_rel_path = rel_path / os.path.relpath(dir_path, host_path)
+                    try:
+                        dir_mtimes[(layer, dir_rel_path)] = os.stat(dir_path).st_mtime_ns
+                    except OSError:
+                        pass
+                    for name in dir_names:
+                        self._add_to(entries, children, dir_rel_path / name, layer, True)
+                    for name in file_names:
+                        self._add_to(entries, children, dir_rel_path / name, layer, False)
+            elif os.path.lexists(host_path):
+                self._add_to(entries, children, rel_path, layer, False)
+        return (entries, children, dir_mtimes)
+
+    def _apply(self, rel_path: PPPath, entries: typing.Dict[PPPath, list],
+               children: typing.Dict[PPPath, typing.Set[str]],
+               dir_mtimes: typing.Dict[typing.Tuple[int, PPPath], int]) -> None:
+        """Replaces everything under a path with the result of _scan_tree. Must be called with the lock held.
+        lookup() does not take the lock, so new entries are stored before stale ones are removed:
+        paths that exist before and after the update are never seen as missing."""
+        old_paths = []
+        pending = [rel_path]
+        while pending:
+            path = pending.pop()
+            old_paths.append(path)
+            pending.extend(path / name for name in self._children.get(path, ()))
+
+        self._entries.update(entries)
+        for path in old_paths:
+            if path not in entries:
+                # The path may never have been indexed (e.g. it was created and deleted before its event arrived).
+                self._entries.pop(path, None)
+            self._children.pop(path, None)
+            for layer in range(len(self._dirs)):
+                self._dir_mtimes.pop((layer, path), None)
+        if rel_path != PPPath('.'):
+            # The parent is outside the updated subtree, so its set of children is only changed for this path.
+            children.pop(rel_path.parent, None)
+            if rel_path in entries:
+                self._children.setdefault(rel_path.parent, set()).add(rel_path.name)
+            else:
+                self._children.get(rel_path.parent, set()).discard(rel_path.name)
+        self._children.update(children)
+        self._dir_mtimes.update(dir_mtimes)
+
+    def _update(self, rel_path: PPPath) -> None:
+        self._apply(rel_path, *self._scan_tree(rel_path))
+
+    def update(self, rel_path: typing.Optional[PPPath]) -> None:
+        """Rescans a path (or everything if None) after it has changed on the host."""
+        rel_path = rel_path or PPPath('.')
+        with self._update_lock:
+            with self._lock:
+                if not self.ready:
+                    self._pending_updates.append(rel_path)
+                    return
+            # Scan without holding the lock so that listings are not blocked by the walk.
+            scanned = self._scan_tree(rel_path)
+            with self._lock:
+                self._apply(rel_path, *scanned)
+
+    def get_state(self) -> typing.Tuple[list, list]:
+        """Returns the entries and directory mtimes for saving into a snapshot."""
+        with self._lock:
+            entries = [(rel_path, entry[0], entry[1], entry[2]) for rel_path, entry in self._entries.items()]
+            dir_mtimes = [(layer, rel_path, mtime) for (layer, rel_path), mtime in self._dir_mtimes.items()]
+        return (entries, dir_mtimes)
+
+    def load_state(self, entries: list, dir_mtimes: list) -> typing.Set[PPPath]:
+        """Restores the index from a snapshot. Directories that have changed since the snapshot
+        was taken are scanned again. Returns the set of those directories."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            def is_stale(item) -> bool:
+                layer, rel_path, mtime = item
+                try:
+                    return os.stat(str(self._dirs[layer] / rel_path)).st_mtime_ns != mtime
+                except OSError:
+                    return True
+            stale = {item[1] for item, changed in zip(dir_mtimes, executor.map(is_stale, dir_mtimes)) if changed}
+        with self._lock:
+            for rel_path, layer, file_layer, is_dir in entries:
+                self._entries[rel_path] = [layer, file_layer, is_dir]
+                if rel_path != PPPath('.'):
+                    self._children.setdefault(rel_path.parent, set()).add(rel_path.name)
+                if is_dir:
+                    self._children.setdefault(rel_path, set())
+            for layer, rel_path, mtime in dir_mtimes:
+                self._dir_mtimes[(layer, rel_path)] = mtime
+            for rel_path in stale:
+                if rel_path in self._entries or rel_path == PPPath('.'):
+                    self._update(rel_path)
+            self.ready = True
+            for rel_path in self._pending_updates:
+                self._update(rel_path)
+            self._pending_updates = []
+        return stale
+
+    def lookup(self, rel_path: PPPath) -> typing.Optional[typing.Tuple[int, int, bool]]:
+        entry = self._entries.get(rel_path)
+        return tuple(entry) if entry else None # type: ignore
+
+    def list(self, rel_path: PPPath) -> typing.Set[str]:
+        with self._lock:
+            return set(self._children.get(rel_path, ()))
+
 class ContentDirectory(Directory):
     __slots__ = ('_content_device', '_rel_path')
     def __init__(self, base_path: PPPath, path: PPPath, content_device) -> None:
@@ -209,6 +1178,8 @@ class ContentDirectory(Directory):
         self._rel_path = path.relative_to(base_path)
 
     def _do_list_files(self, path: PPPath) -> typing.Collection[str]:
+        if self._content_device.layers.ready:
+            return self._content_device.layers.list(self._rel_path / path)
         entries = set()
         for d in reversed(self._content_device.dirs):
             try:
@@ -217,10 +1188,19 @@ class ContentDirectory(Directory):
                 pass
         return entries
 
-    @functools.lru_cache(maxsize=2**15)
     def _find_parent(self, path: PPPath, existence_fn: typing.Callable[[PPPath], bool]) -> PPPath:
         if str(path) == '.':
             return self._content_device.dirs[-1]
+        if self._content_device.layers.ready:
+            entry = self._content_device.layers.lookup(path)
+            layer = -1 if entry is None else (entry[1] if existence_fn is os.path.isfile else entry[0])
+            if layer == -1:
+                raise FuseOSError(errno.ENOENT)
+            return self._content_device.dirs[layer]
+        return self._content_device.cache.get(path, existence_fn.__name__,
+                                              lambda: self._do_find_parent(path, existence_fn))
+
+    def _do_find_parent(self, path: PPPath, existence_fn: typing.Callable[[PPPath], bool]) -> PPPath:
         for d in reversed(self._content_device.dirs):
             try:
                 if existence_fn(d / path):
@@ -232,57 +1212,597 @@ class ContentDirectory(Directory):
     def list_files(self, path):
         return self._do_list_files(path)
 
+    def list_files_with_stats(self, path: PPPath) -> typing.List[typing.Tuple[str, dict]]:
+        # One scan per layer instead of looking up and stat'ing every entry separately.
+        rel_path = self._rel_path / path
+        cache = self._content_device.cache
+        generation = cache.generation
+        stats: typing.Dict[str, dict] = dict()
+        for d in reversed(self._content_device.dirs):
+            try:
+                with os.scandir(str(d / rel_path)) as it:
+                    for entry in it:
+                        if entry.name not in stats:
+                            stats[entry.name] = my_stat(entry.stat(follow_symlinks=False))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        cache.put_all('stat', ((rel_path / name, st) for name, st in stats.items()), generation)
+        return [(name, dict(st)) for name, st in stats.items()]
+
     def open_file(self, file: PPPath, flags) -> File:
         p = self._rel_path / file
         return HostFile(os.open(self._find_parent(p, os.path.isfile) / p, flags | BINARY_MODE))
 
-    @functools.lru_cache(maxsize=2**13)
     def _do_get_file_stats(self, path: PPPath) -> dict:
         p = self._rel_path / path
-        return dict(my_stat(os.lstat(self._find_parent(p, os.path.exists) / p)))
+        return self._content_device.cache.get(p, 'stat',
+                                              lambda: my_stat(os.lstat(self._find_parent(p, os.path.exists) / p)))
 
     def get_file_stats(self, path):
         return dict(self._do_get_file_stats(path))
 
+    def get_source_key(self, path: PPPath) -> str:
+        p = self._rel_path / path
+        return str(self._find_parent(p, os.path.exists) / p)
+
 class ContentDevice:
     ROOT_STR = '!!!content!!!'
     ROOT = PPPath(ROOT_STR)
 
-    def __init__(self, content_dirs: typing.List[PPPath]) -> None:
+    def __init__(self, content_dirs: typing.List[PPPath], cache_size: int = 2**18) -> None:
         self.dirs = content_dirs
+        # Keyed by paths relative to the content root.
+        self.cache = MetadataCache(cache_size)
+        # Not used until it has been built.
+        self.layers = LayerIndex(content_dirs)
+
+    def invalidate(self, rel_path: typing.Optional[PPPath], is_dir: bool) -> None:
+        self.cache.invalidate(rel_path, is_dir)
+        self.layers.update(rel_path)
+
+    _SNAPSHOT_MAGIC = b'BFCS'
+    _SNAPSHOT_VERSION = 2
+    _SNAPSHOT_ENTRY = struct.Struct('<iib')
+    _SNAPSHOT_DIR = struct.Struct('<iq')
+
+    def save_snapshot(self, file_path: str) -> None:
+        """Saves the layer index, so that the next mount can skip scanning the layers.
+        File stats are not saved: rewriting a file does not change the mtime of its directory,
+        so they cannot be validated without stat'ing every file again."""
+        if not self.layers.ready:
+            return
+        entries, dir_mtimes = self.layers.get_state()
+
+        parts = [self._SNAPSHOT_MAGIC, struct.pack('<II', self._SNAPSHOT_VERSION, len(self.dirs))]
+        parts += [pack_str(str(d)) for d in self.dirs]
+        parts.append(struct.pack('<I', len(dir_mtimes)))
+        for layer, rel_path, mtime in dir_mtimes:
+            parts += [self._SNAPSHOT_DIR.pack(layer, mtime), pack_str(str(rel_path))]
+        parts.append(struct.pack('<I', len(entries)))
+        for rel_path, layer, file_layer, is_dir in entries:
+            parts += [self._SNAPSHOT_ENTRY.pack(layer, file_layer, is_dir), pack_str(str(rel_path))]
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(b''.join(parts))
+        os.replace(temp_path, file_path)
+
+    def load_snapshot(self, file_path: str) -> bool:
+        """Restores the layer index from a snapshot. Returns False if the snapshot
+        does not exist or was taken with different content directories."""
+        try:
+            with open(file_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        with data:
+            offset = 0
+            def read(st: struct.Struct) -> tuple:
+                nonlocal offset
+                values = st.unpack_from(data, offset)
+                offset += st.size
+                return values
+            def read_u32() -> int:
+                nonlocal offset
+                offset += 4
+                return struct.unpack_from('<I', data, offset - 4)[0]
+            def read_str() -> str:
+                nonlocal offset
+                size = read_u32()
+                offset += size
+                return data[offset - size:offset].decode()
+
+            try:
+                if data[0:4] != self._SNAPSHOT_MAGIC:
+                    return False
+                offset = 4
+                if read_u32() != self._SNAPSHOT_VERSION:
+                    return False
+                if [read_str() for _ in range(read_u32())] != [str(d) for d in self.dirs]:
+                    return False
+                dir_mtimes = []
+                for _ in range(read_u32()):
+                    layer, mtime = read(self._SNAPSHOT_DIR)
+                    dir_mtimes.append((layer, PPPath(read_str()), mtime))
+                entries = []
+                for _ in range(read_u32()):
+                    layer, file_layer, is_dir = read(self._SNAPSHOT_ENTRY)
+                    entries.append((PPPath(read_str()), layer, file_layer, bool(is_dir)))
+            except (struct.error, UnicodeDecodeError):
+                return False
+
+        self.layers.load_state(entries, dir_mtimes)
+        return True
 
-    @functools.lru_cache(maxsize=2**15)
     def isdir(self, path: PPPath) -> bool:
-        return any(os.path.isdir(str(path).replace(self.ROOT_STR, str(d))) for d in reversed(self.dirs))
+        rel_path = path.relative_to(self.ROOT)
+        if self.layers.ready:
+            entry = self.layers.lookup(rel_path)
+            return entry is not None and entry[2]
+        return self.cache.get(rel_path, 'isdir',
+                              lambda: any(os.path.isdir(d / rel_path) for d in reversed(self.dirs)))
 
-    @functools.lru_cache(maxsize=2**15)
     def try_open_dir(self, path: PPPath) -> typing.Optional[ContentDirectory]:
-        for d in reversed(self.dirs):
-            if os.path.isdir(str(path).replace(self.ROOT_STR, str(d))):
-                return ContentDirectory(self.ROOT, path, self)
+        if self.isdir(path):
+            return ContentDirectory(self.ROOT, path, self)
         return None
 
     def is_content_path(self, path: PPPath) -> bool:
         return path.parts[0] == self.ROOT_STR
 
+def _recover_from_watch_error(callback: typing.Callable[[typing.Optional[str], typing.Optional[PPPath], bool], None],
+                              error: Exception) -> None:
+    """Reports an error from handling a change and drops everything that is cached instead,
+    so that the watcher keeps running."""
+    sys.stderr.write('warning: failed to handle a change: %r\n' % error)
+    try:
+        callback(None, None, True)
+    except Exception as e:
+        sys.stderr.write('warning: failed to drop cached data: %r\n' % e)
+
+class InotifyWatcher:
+    """Watches directory trees for changes using inotify (Linux only). The callback is passed the root
+    a change was made in (None if any may have changed), the path relative to it and whether it is a directory."""
+    _IN_ATTRIB = 0x4
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_DELETE_SELF = 0x400
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ONLYDIR = 0x1000000
+    _IN_ISDIR = 0x40000000
+    _MASK = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE |
+             _IN_DELETE_SELF | _IN_ONLYDIR)
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, roots: typing.List[str], callback: typing.Callable[[typing.Optional[str], typing.Optional[PPPath], bool], None]) -> None:
+        self._callback = callback
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # Watch descriptor -> (root, directory path relative to the root)
+        self._watches: typing.Dict[int, typing.Tuple[str, PPPath]] = dict()
+        try:
+            for root in roots:
+                self._add_tree(root, PPPath('.'))
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _add_tree(self, root: str, rel_path: PPPath) -> None:
+        for dir_path, _, _ in os.walk(os.path.join(root, str(rel_path))):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), self._MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % dir_path)
+            self._watches[wd] = (root, PPPath(os.path.relpath(dir_path, root)))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._thread.join()
+        os.close(self._fd)
+
+    def _run(self) -> None:
+        while not self._stopped:
+            if not select.select([self._fd], [], [], 1.0)[0]:
+                continue
+            try:
+                buf = os.read(self._fd, 0x10000)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, name_len = self._EVENT_HEADER.unpack_from(buf, offset)
+                offset += self._EVENT_HEADER.size
+                name = buf[offset:offset + name_len].rstrip(b'\x00')
+                offset += name_len
+                try:
+                    self._handle_event(wd, mask, os.fsdecode(name))
+                except Exception as e:
+                    _recover_from_watch_error(self._callback, e)
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & self._IN_Q_OVERFLOW:
+            self._callback(None, None, True)
+            return
+        watch = self._watches.get(wd)
+        if not watch:
+            return
+        root, dir_rel_path = watch
+        if mask & self._IN_IGNORED:
+            del self._watches[wd]
+            return
+        if mask & self._IN_DELETE_SELF:
+            self._callback(root, dir_rel_path, True)
+            return
+        rel_path = dir_rel_path / name
+        is_dir = bool(mask & self._IN_ISDIR)
+        if is_dir and mask & (self._IN_CREATE | self._IN_MOVED_TO):
+            try:
+                self._add_tree(root, rel_path)
+            except OSError:
+                pass
+        self._callback(root, rel_path, is_dir)
+
+class PollingWatcher:
+    """Watches directory trees for added and removed entries by periodically checking
+    directory modification times. Changes to existing files are not detected."""
+    def __init__(self, roots: typing.List[str], callback: typing.Callable[[typing.Optional[str], typing.Optional[PPPath], bool], None],
+                 interval: float) -> None:
+        self._roots = roots
+        self._callback = callback
+        self._interval = interval
+        # Directory host path -> (root, relative path, mtime, entry names)
+        self._dirs: typing.Dict[str, typing.Tuple[str, PPPath, int, typing.Set[str]]] = dict()
+        for root in roots:
+            self._scan_tree(root, PPPath('.'))
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _scan_tree(self, root: str, rel_path: PPPath) -> None:
+        for dir_path, dir_names, file_names in os.walk(os.path.join(root, str(rel_path))):
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            self._dirs[dir_path] = (root, PPPath(os.path.relpath(dir_path, root)), mtime, set(dir_names + file_names))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            for dir_path in list(self._dirs):
+                try:
+                    self._check_dir(dir_path)
+                except Exception as e:
+                    _recover_from_watch_error(self._callback, e)
+
+    def _check_dir(self, dir_path: str) -> None:
+        root, rel_path, mtime, names = self._dirs[dir_path]
+        try:
+            new_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            del self._dirs[dir_path]
+            self._callback(root, rel_path, True)
+            return
+        if new_mtime == mtime:
+            return
+        try:
+            new_names = set(os.listdir(dir_path))
+        except OSError:
+            return
+        self._dirs[dir_path] = (root, rel_path, new_mtime, new_names)
+        for name in names ^ new_names:
+            is_dir = os.path.isdir(os.path.join(dir_path, name))
+            if is_dir and name in new_names:
+                self._scan_tree(root, rel_path / name)
+            self._callback(root, rel_path / name, True)
+
+def make_watcher(roots: typing.List[str],
+                 callback: typing.Callable[[typing.Optional[str], typing.Optional[PPPath], bool], None],
+                 poll_interval: float):
+    """Returns an inotify watcher if possible, and a polling watcher otherwise."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots, callback)
+        except (OSError, AttributeError) as e:
+            sys.stderr.write('warning: cannot use inotify (%s); falling back to polling\n' % e)
+    return PollingWatcher(roots, callback, poll_interval)
+
 class BotWContent(Operations):
-    def __init__(self, content_device: ContentDevice, work_dir: typing.Optional[str]) -> None:
+    # Read-only directory that is served from memory and not listed in the root directory.
+    CONTROL_DIR = PPPath('.botwfs')
+    STATS_FILE = CONTROL_DIR / 'stats'
+    PROFILE_FILE = CONTROL_DIR / 'profile'
+    # Directory in the work dir where files are copied before they are moved into place.
+    COPY_TEMP_DIR = PPPath('.botwfs-tmp')
+    TIMED_OPERATIONS = frozenset(('getattr', 'readdir', 'open', 'read'))
+    # Number of archives from the access profile that are loaded ahead of the one being read.
+    PREFETCH_DISTANCE = 8
+
+    def __init__(self, content_device: ContentDevice, work_dir: typing.Optional[str],
+                 archive_cache: typing.Optional[DecompressedArchiveCache] = None,
+                 max_archive_memory: int = 2048 * 1024 * 1024,
+                 pinned_archives: typing.Collection[str] = (),
+                 snapshot_path: typing.Optional[str] = None,
+                 catalog: typing.Optional[ArchiveCatalog] = None,
+                 profiler: typing.Optional[Profiler] = None,
+                 tracer: typing.Optional[TraceRecorder] = None,
+                 access_profile: typing.Optional[AccessProfile] = None) -> None:
         self.content_device = content_device
+        self.catalog = catalog
+        # Stats of paths in the content view, including archive members. Filled by readdir.
+        self.stat_cache = MetadataCache(2**16)
+        self.snapshot_path = snapshot_path
         self.work_dir = PPPath(work_dir) if work_dir else None
+        if self.work_dir:
+            # Left over from copies that were interrupted by a crash.
+            shutil.rmtree(self.work_dir / BotWContent.COPY_TEMP_DIR, ignore_errors=True)
+        self.archive_cache = archive_cache
+        # Keys are (base path, path, kind) where kind is 'sarc' for fully loaded archives,
+        # 'index' for archives of which only the header was read and 'checkpoints' for Yaz0 checkpoint indexes.
+        self.archives: ArchiveCache[typing.Tuple[PPPath, PPPath, str], typing.Any] = ArchiveCache(max_archive_memory)
+        self.pinned_archives = set(pinned_archives)
+        # Builds Yaz0 checkpoint indexes in the background.
+        self._checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.access_profile = access_profile
+        # Loads archives that are expected to be read soon according to the access profile.
+        self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if access_profile:
+            self._schedule_prefetch(0)
         self.sarcs: typing.Dict[str, sarc.SARC] = dict()
         self.fd_map: FdAllocator[File] = FdAllocator()
         self.fd_lock = threading.Lock()
+        # Files that are being copied to the work dir. Protected by _copy_lock.
+        self._copying: typing.Dict[PPPath, _PendingLoad] = dict()
+        self._copy_lock = threading.Lock()
+        self.op_stats = OperationStats()
+        self.profiler = profiler
+        self.tracer = tracer
+        # Contents of the stats file as of the last getattr, so that its size matches what open returns.
+        self._stats_text = b''
+
+    def __call__(self, op, *args):
+        if self.tracer is not None:
+            return self.tracer.call(op, self._dispatch, *args)
+        return self._dispatch(op, *args)
+
+    def _dispatch(self, op, *args):
+        if self.profiler is not None and self.profiler.active:
+            return self.profiler.call(op, self._timed_call, op, *args)
+        return self._timed_call(op, *args)
+
+    def _timed_call(self, op, *args):
+        if op not in BotWContent.TIMED_OPERATIONS:
+            return super().__call__(op, *args)
+        start = time.perf_counter()
+        try:
+            result = super().__call__(op, *args)
+            if op == 'readdir':
+                # Generators do their work when they are iterated.
+                result = list(result)
+            return result
+        finally:
+            self.op_stats.record(op, time.perf_counter() - start)
+
+    def format_stats(self) -> str:
+        lines = self.op_stats.format()
+        cache_stats = self.archives.get_stats()
+        for key in ('hits', 'misses', 'waits', 'evictions', 'entries', 'pinned_entries', 'size', 'pinned_size', 'max_size'):
+            lines.append('archive_cache.%s %d' % (key, cache_stats[key]))
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        lines.append('archive_cache.hit_rate %.4f' % (cache_stats['hits'] / lookups if lookups else 0))
+        with self.fd_lock:
+            lines.append('handles.live %d' % len(self.fd_map))
+            lines.append('handles.peak %d' % self.fd_map.peak_count)
+        # Decompressed size of every fully loaded archive.
+        for (base_path, path, kind), size in sorted(self.archives.get_sizes(), key=lambda item: str(item[0][1])):
+            if kind == 'sarc':
+                lines.append('%s.%s %d' % ('archive' if base_path == ContentDevice.ROOT else 'work_archive', path, size))
+        return '\n'.join(lines) + '\n'
+
+    def _is_control_path(self, _path: PPPath) -> bool:
+        return _path == BotWContent.CONTROL_DIR or BotWContent.CONTROL_DIR in _path.parents
+
+    def _getattr_control(self, _path: PPPath) -> dict:
+        st = my_stat(os.stat(self.content_device.dirs[-1]))
+        if _path == BotWContent.CONTROL_DIR:
+            st['st_mode'] = stat.S_IFDIR | 0o555
+            st['st_nlink'] = 2
+            st['st_size'] = 0
+            return st
+        if _path == BotWContent.STATS_FILE:
+            self._stats_text = self.format_stats().encode()
+            st['st_mode'] = stat.S_IFREG | 0o444
+            st['st_nlink'] = 1
+            st['st_size'] = len(self._stats_text)
+            st['st_mtime'] = st['st_ctime'] = st['st_atime'] = time.time()
+            return st
+        if _path == BotWContent.PROFILE_FILE and self.profiler:
+            st['st_mode'] = stat.S_IFREG | 0o644
+            st['st_nlink'] = 1
+            st['st_size'] = len(self._get_profile_status())
+            return st
+        raise FuseOSError(errno.ENOENT)
 
-    @functools.lru_cache(maxsize=64)
-    def _get_sarc(self, base_path: PPPath, path: PPPath) -> typing.Tuple[Directory, sarc.SARC]:
+    def _get_profile_status(self) -> bytes:
+        return b'on\n' if self.profiler and self.profiler.active else b'off\n'
+
+    def _on_profile_write(self, data: bytes) -> None:
+        command = data.strip()
+        if command in (b'1', b'on', b'start'):
+            self.profiler.start() # type: ignore
+        elif command in (b'0', b'off', b'stop'):
+            self.profiler.stop() # type: ignore
+        elif command:
+            raise FuseOSError(errno.EINVAL)
+
+    def invalidate(self, path: typing.Optional[PPPath], is_dir: bool, in_content_dirs: bool = True) -> None:
+        """Drops cached data for a path (relative to a content or work directory) that has changed on the host.
+        Changes that are only in the work dir do not affect the content device."""
+        if in_content_dirs or path is None:
+            self.content_device.invalidate(path, is_dir)
+        # Stats for archive members are cached under the archive's path.
+        self.stat_cache.invalidate(path, is_dir or (path is not None and is_archive_filename(path)))
+        if path is None:
+            self.archives.remove_if(lambda key: True)
+        else:
+            self.archives.remove_if(lambda key: key[1] == path or path in key[1].parents)
+
+    def _get_sarc(self, base_path: PPPath, path: PPPath) -> typing.Tuple[Directory, sarc.SARC, ArchiveIndex]:
+        return self.archives.get((base_path, path, 'sarc'), lambda: self._load_sarc(base_path, path),
+                                 pin=path.name in self.pinned_archives)
+
+    def _get_archive_index(self, base_path: PPPath, path: PPPath) -> typing.Tuple[Directory, ArchiveIndex]:
+        loaded = self.archives.peek((base_path, path, 'sarc'))
+        if loaded:
+            return (loaded[0], loaded[2])
+        return self.archives.get((base_path, path, 'index'), lambda: self._load_archive_index(base_path, path),
+                                 pin=path.name in self.pinned_archives)
+
+    def _load_archive_index(self, base_path: PPPath, path: PPPath) -> typing.Tuple[typing.Tuple[Directory, ArchiveIndex], int]:
+        parent = self._get_directory(base_path, path.parent)
+        archive_path = parent.get_path_relative_to_this(path)
+        header = None
+        if self.archive_cache or self.catalog:
+            source_key = parent.get_source_key(archive_path)
+            key = make_archive_key(source_key, parent.get_file_stats(archive_path))
+        if self.catalog:
+            entries = self.catalog.get(key)
+            if entries is not None:
+                index = ArchiveIndex(entries)
+                return ((parent, index), len(index.files) * 0x100)
+        if self.archive_cache:
+            header = self.archive_cache.get(key)
+        if header is None:
+            archive_file = parent.open_file(archive_path, os.O_RDONLY)
+            header, compressed = read_sarc_header(archive_file)
+            if header is not None and compressed:
+                self.op_stats.add_decompressed(len(header))
+        if header is None:
+            raise FuseOSError(errno.ENOENT)
+        # Only the header is needed to parse the file table.
+        index = ArchiveIndex.from_sarc(_SARC(header))
+        if self.catalog:
+            self.catalog.put(key, source_key, index)
+        # Rough estimate of the memory used by the index.
+        return ((parent, index), len(index.files) * 0x100)
+
+    def _load_sarc(self, base_path: PPPath, path: PPPath) -> typing.Tuple[typing.Tuple[Directory, sarc.SARC, ArchiveIndex], int]:
         parent = self._get_directory(base_path, path.parent)
-        archive_file = parent.open_file(parent.get_path_relative_to_this(path), os.O_RDONLY)
-        archive = sarc.read_file_and_make_sarc(
-            io.BytesIO(archive_file.read(archive_file.get_size())))
+        archive_path = parent.get_path_relative_to_this(path)
+        archive = None
+        cached_data = None
+        if self.archive_cache:
+            cache_key = make_archive_key(parent.get_source_key(archive_path), parent.get_file_stats(archive_path))
+            cached_data = self.archive_cache.get(cache_key)
+            if cached_data is not None:
+                archive = _SARC(cached_data)
+        if not archive:
+            archive_file = parent.open_file(archive_path, os.O_RDONLY)
+            # For archives that are nested in an uncompressed archive, this is a view into the parent's data.
+            data = archive_file.get_data()
+            archive = make_sarc(data)
+            if archive and data[0:4] == b'Yaz0':
+                self.op_stats.add_decompressed(len(archive._data))
+            if archive and self.archive_cache and data[0:4] == b'Yaz0':
+                self.archive_cache.put(cache_key, archive._data)
+                cached_data = archive._data
+        # Checkpoints are only worth it for archives that take a while to decompress.
+        if self.archive_cache and cached_data is not None and len(cached_data) >= Yaz0CheckpointIndex.MIN_DATA_SIZE:
+            self._checkpoint_executor.submit(self._build_yaz0_checkpoints, cache_key, parent, archive_path)
         if archive:
-            return (parent, archive)
+            # Nested uncompressed archives are views into their parent's data, which stays in memory
+            # as long as they do, even after the parent is evicted. They are charged for the whole buffer.
+            self.archives.remove_if(lambda key: key == (base_path, path, 'index'))
+            index = ArchiveIndex.from_sarc(archive)
+            if self.catalog:
+                source_key = parent.get_source_key(archive_path)
+                key = make_archive_key(source_key, parent.get_file_stats(archive_path))
+                if not self.catalog.has(key):
+                    self.catalog.put(key, source_key, index)
+            return ((parent, archive, index), memoryview(archive._data.obj).nbytes)
         raise FuseOSError(errno.ENOENT)
 
+    def _record_access(self, path: PPPath) -> None:
+        position = self.access_profile.record(str(path)) # type: ignore
+        if position is not None:
+            self._schedule_prefetch(position + 1)
+
+    def _schedule_prefetch(self, position: int) -> None:
+        for path in self.access_profile.take_upcoming(position, BotWContent.PREFETCH_DISTANCE): # type: ignore
+            self._prefetch_executor.submit(self._prefetch_archive, PPPath(path))
+
+    def _prefetch_archive(self, path: PPPath) -> None:
+        if self.archives.peek((ContentDevice.ROOT, path, 'sarc')):
+            return
+        try:
+            # Do not evict archives that are in use for ones that might be.
+            if path.name not in self.pinned_archives and not self.archives.has_room(self._get_load_size(path)):
+                return
+            self._get_sarc(ContentDevice.ROOT, path)
+        except (OSError, ValueError):
+            pass
+
+    def _get_load_size(self, path: PPPath) -> int:
+        """Returns roughly how much loading an archive would add to the archive cache, without loading it."""
+        size = 0
+        while not self.archives.peek((ContentDevice.ROOT, path, 'sarc')):
+            parent = self._get_directory(ContentDevice.ROOT, path.parent)
+            archive_path = parent.get_path_relative_to_this(path)
+            if not isinstance(parent, ArchiveDirectory):
+                header = parent.open_file(archive_path, os.O_RDONLY).pread(8, 0)
+                if header[0:4] == b'Yaz0':
+                    return size + Yaz0Decoder.get_uncompressed_size(header)
+                return size + parent.get_file_stats(archive_path)['st_size']
+            # Reading the header of a nested archive would load the archive that contains it,
+            # so use the stored size and count the containing archive as well.
+            size += parent.get_file_stats(archive_path)['st_size']
+            path = PPPath(*path.parts[:-len(archive_path.parts)])
+        return size
+
+    def warm_up(self, jobs: int) -> None:
+        """Loads the archives in the content directories in the background, pinned and larger
+        archives first, as long as they fit in the archive cache without evicting anything."""
+        archives: typing.Dict[PPPath, typing.Tuple[bool, int]] = dict()
+        for d in self.content_device.dirs:
+            for dir_path, _, file_names in os.walk(str(d)):
+                for name in file_names:
+                    rel_path = PPPath(os.path.relpath(os.path.join(dir_path, name), str(d)))
+                    if not is_archive_filename(rel_path):
+                        continue
+                    try:
+                        size = os.path.getsize(os.path.join(dir_path, name))
+                    except OSError:
+                        continue
+                    # Later directories take precedence.
+                    archives[rel_path] = (name in self.pinned_archives, size)
+
+        def load(rel_path: PPPath) -> None:
+            try:
+                if rel_path.name not in self.pinned_archives and not self.archives.has_room(self._get_load_size(rel_path)):
+                    return
+                self._get_sarc(ContentDevice.ROOT, rel_path)
+            except (OSError, ValueError):
+                pass
+
+        order = sorted(archives, key=lambda rel_path: archives[rel_path], reverse=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for _ in executor.map(load, order):
+                pass
+
     def _get_directory(self, base_path: PPPath, path: PPPath) -> Directory:
         while True:
             full_path = base_path / path
@@ -291,25 +1811,79 @@ class BotWContent(Operations):
                 if content_dir:
                     return content_dir
                 if is_archive_filename(full_path) and not self.content_device.isdir(full_path):
-                    directory, archive = self._get_sarc(base_path, path)
-                    return ArchiveDirectory(base_path, full_path, archive, directory)
+                    return self._open_archive_directory(base_path, path)
             else:
                 if os.path.isdir(full_path):
                     return HostDirectory(base_path, full_path)
                 if is_archive_filename(full_path) and not os.path.isdir(full_path):
-                    directory, archive = self._get_sarc(base_path, path)
-                    return ArchiveDirectory(base_path, full_path, archive, directory)
+                    return self._open_archive_directory(base_path, path)
             path = path.parent
 
+    def _open_archive_directory(self, base_path: PPPath, path: PPPath) -> ArchiveDirectory:
+        directory, index = self._get_archive_index(base_path, path)
+        return ArchiveDirectory(base_path, base_path / path,
+                                lambda name, size, offset: self._read_archive_member(base_path, path, name, size, offset),
+                                index, directory)
+
+    def _read_archive_member(self, base_path: PPPath, path: PPPath, name: str, size: int, offset: int) -> memoryview:
+        if self.access_profile and base_path == ContentDevice.ROOT:
+            self._record_access(path)
+        loaded = self.archives.peek((base_path, path, 'sarc'))
+        if not loaded and self.archive_cache:
+            # Decompressing a member from the nearest checkpoint is cheaper than decompressing
+            # the entire archive if the span to decode is small enough to make up for the slower
+            # decoder, unless the decompressed archive is in the on-disk cache.
+            parent, _ = self._get_archive_index(base_path, path)
+            archive_path = parent.get_path_relative_to_this(path)
+            cache_key = make_archive_key(parent.get_source_key(archive_path), parent.get_file_stats(archive_path))
+            if (not self.archive_cache.has(cache_key)
+                    and self.archive_cache.has(cache_key, DecompressedArchiveCache.CHECKPOINTS_SUFFIX)):
+                checkpoints = self.archives.get((base_path, path, 'checkpoints'),
+                                                lambda: self._load_yaz0_checkpoints(cache_key))
+                span = offset + size - checkpoints.find(offset)[1]
+                archive_file = parent.open_file(archive_path, os.O_RDONLY)
+                if span * Yaz0Decoder.SLOWDOWN < Yaz0Decoder.get_uncompressed_size(archive_file.pread(8, 0)):
+                    self.op_stats.add_decompressed(span)
+                    return read_yaz0_range(archive_file, checkpoints, offset, size)
+        parent, archive, _ = loaded if loaded else self._get_sarc(base_path, path)
+        try:
+            return archive.get_file_data(name)
+        except KeyError:
+            # The index came from a catalog entry that does not match the archive (e.g. it was
+            # replaced without changing its size and mtime). Drop it so that it is not used again.
+            if self.catalog:
+                archive_path = parent.get_path_relative_to_this(path)
+                self.catalog.remove(make_archive_key(parent.get_source_key(archive_path),
+                                                     parent.get_file_stats(archive_path)))
+            self.archives.remove_if(lambda key: key == (base_path, path, 'index'))
+            self.stat_cache.invalidate(path, True)
+            raise FuseOSError(errno.ENOENT)
+
+    def _load_yaz0_checkpoints(self, cache_key: str) -> typing.Tuple[Yaz0CheckpointIndex, int]:
+        data = self.archive_cache.get(cache_key, DecompressedArchiveCache.CHECKPOINTS_SUFFIX) # type: ignore
+        if data is None:
+            raise FuseOSError(errno.ENOENT)
+        return (Yaz0CheckpointIndex.from_bytes(data), len(data))
+
+    def _build_yaz0_checkpoints(self, cache_key: str, parent: Directory, archive_path: PPPath) -> None:
+        if self.archive_cache.has(cache_key, DecompressedArchiveCache.CHECKPOINTS_SUFFIX): # type: ignore
+            return
+        data = self.archive_cache.get(cache_key) # type: ignore
+        if data is None:
+            return
+        src = parent.open_file(archive_path, os.O_RDONLY).get_data()
+        checkpoints = Yaz0CheckpointIndex.build(src, data)
+        self.archive_cache.put(cache_key, checkpoints.to_bytes(), DecompressedArchiveCache.CHECKPOINTS_SUFFIX) # type: ignore
+
     def _get_file(self, base_path: PPPath, path: PPPath, flags) -> File:
         parent = self._get_directory(base_path, path.parent)
         return parent.open_file(parent.get_path_relative_to_this(path), flags)
 
-    @functools.lru_cache(maxsize=256)
+    # These are not cached: directories and files are cheap to create since host paths and
+    # archives are cached. Every open gets its own File and no host fd is kept open after release.
     def _get_directory_from_content(self, path: PPPath) -> Directory:
         return self._get_directory(ContentDevice.ROOT, path)
 
-    @functools.lru_cache(maxsize=256)
     def _get_file_from_content(self, path: PPPath, flags) -> File:
         return self._get_file(ContentDevice.ROOT, path, flags)
 
@@ -329,32 +1903,70 @@ class BotWContent(Operations):
     def access(self, partial: str, mode):
         pass
 
-    def getattr(self, partial: str, fh=None):
-        _path = self._path(partial)
-
+    def _getattr(self, _path: PPPath) -> dict:
         parent = self._get_parent_directory_from_partial(_path)
         st = parent.get_file_stats(parent.get_path_relative_to_this(_path))
         if is_archive_filename(_path):
             change_st_to_directory(st)
         return st
 
-    def readdir(self, partial: str, fh) -> typing.Iterator[str]:
-        entries = set(['.', '..'])
-
-        if self.work_dir:
-            real_path = self.work_dir / self._path(partial)
-            if os.path.isdir(real_path):
-                entries.update(os.listdir(real_path))
+    def getattr(self, partial: str, fh=None):
+        _path = self._path(partial)
+        if self._is_control_path(_path):
+            return self._getattr_control(_path)
+        # Editors and shells probe many paths that do not exist (.git, desktop.ini, swap files...)
+        # Misses are remembered until something is created at the path.
+        if self.stat_cache.has(_path, 'missing'):
+            raise FuseOSError(errno.ENOENT)
+        generation = self.stat_cache.generation
+        try:
+            # Files in the work directory can be modified through the view, so their stats are never cached.
+            if self.work_dir and os.path.exists(self.work_dir / _path):
+                return self._getattr(_path)
+            return dict(self.stat_cache.get(_path, 'stat', lambda: self._getattr(_path)))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                self.stat_cache.put_all('missing', [(_path, True)], generation)
+            raise
+
+    def readdir(self, partial: str, fh) -> typing.Iterator[typing.Tuple[str, typing.Optional[dict], int]]:
+        _path = self._path(partial)
+        entries: typing.Dict[str, dict] = dict()
+        if self._is_control_path(_path):
+            if _path != BotWContent.CONTROL_DIR:
+                raise FuseOSError(errno.ENOTDIR)
+            yield ('.', None, 0)
+            yield ('..', None, 0)
+            yield (BotWContent.STATS_FILE.name, self._getattr_control(BotWContent.STATS_FILE), 0)
+            if self.profiler:
+                yield (BotWContent.PROFILE_FILE.name, self._getattr_control(BotWContent.PROFILE_FILE), 0)
+            return
 
         try:
-            _path = self._path(partial)
+            generation = self.stat_cache.generation
             directory = self._get_directory_from_content(_path)
-            entries.update(directory.list_files(directory.get_path_relative_to_this(_path)))
+            entries.update(directory.list_files_with_stats(directory.get_path_relative_to_this(_path)))
+            for name, st in entries.items():
+                if is_archive_filename(_path / name):
+                    change_st_to_directory(st)
+            self.stat_cache.put_all('stat', ((_path / name, dict(st)) for name, st in entries.items()), generation)
         except FuseOSError:
             pass
 
-        for r in entries:
-            yield r
+        if self.work_dir:
+            real_path = self.work_dir / _path
+            if os.path.isdir(real_path):
+                for name, st in HostDirectory(self.work_dir, real_path).list_files_with_stats(PPPath()):
+                    if _path / name == BotWContent.COPY_TEMP_DIR:
+                        continue
+                    if is_archive_filename(_path / name):
+                        change_st_to_directory(st)
+                    entries[name] = st
+
+        yield ('.', None, 0)
+        yield ('..', None, 0)
+        for name, st in entries.items():
+            yield (name, st, 0)
 
     def rmdir(self, partial: str):
         _path = self._path(partial)
@@ -364,10 +1976,11 @@ class BotWContent(Operations):
 
     def mkdir(self, partial: str, mode):
         _path = self._path(partial)
-        if not self.work_dir:
+        if not self.work_dir or self._is_control_path(_path):
             raise FuseOSError(errno.EROFS)
         # TODO: error if the parent does not exist?
-        return os.makedirs(self.work_dir / _path, mode)
+        os.makedirs(self.work_dir / _path, mode)
+        self.stat_cache.invalidate(_path, True)
 
     def statfs(self, partial: str):
         if os.name == 'nt':
@@ -393,49 +2006,105 @@ class BotWContent(Operations):
     def rename(self, old: str, new: str):
         if not self.work_dir or not os.path.exists(self.work_dir / self._path(old)):
             raise FuseOSError(errno.EROFS)
-        return os.rename(self.work_dir / self._path(old), self.work_dir / self._path(new))
+        os.rename(self.work_dir / self._path(old), self.work_dir / self._path(new))
+        self.stat_cache.invalidate(self._path(new), True)
 
     def utimens(self, path, times=None):
         pass
 
     def open(self, partial: str, flags) -> int:
-        with self.fd_lock:
-            _path = self._path(partial)
-            if (flags & os.O_WRONLY or flags & os.O_RDWR):
-                if not self.work_dir:
+        _path = self._path(partial)
+        if self._is_control_path(_path):
+            file: File
+            if _path == BotWContent.PROFILE_FILE and self.profiler:
+                file = ControlFile(self._get_profile_status, self._on_profile_write)
+            elif _path == BotWContent.STATS_FILE:
+                if flags & os.O_WRONLY or flags & os.O_RDWR:
                     raise FuseOSError(errno.EROFS)
-                if not os.path.exists(self.work_dir / _path):
-                    os.makedirs(self.work_dir / _path.parent, exist_ok=True)
-                    with open(self.work_dir / _path, 'wb') as target:
-                        file = self._get_file_from_content(_path, os.O_RDONLY)
-                        target.write(file.read(file.get_size())) # type: ignore
-                return self.fd_map.allocate(HostFile(os.open(self.work_dir / _path, flags | BINARY_MODE)))
-            return self.fd_map.allocate(self._get_file_from_partial(_path, os.O_RDONLY))
+                file = InMemoryFile(memoryview(self._stats_text or self.format_stats().encode()))
+            else:
+                raise FuseOSError(errno.ENOENT)
+            with self.fd_lock:
+                return self.fd_map.allocate(file)
+        if (flags & os.O_WRONLY or flags & os.O_RDWR):
+            if not self.work_dir:
+                raise FuseOSError(errno.EROFS)
+            self._copy_up(self.work_dir, _path)
+            file = HostFile(os.open(self.work_dir / _path, flags | BINARY_MODE))
+        else:
+            file = self._get_file_from_partial(_path, os.O_RDONLY)
+        with self.fd_lock:
+            return self.fd_map.allocate(file)
+
+    def _copy_up(self, work_dir: PPPath, _path: PPPath) -> None:
+        """Copies a file to the work dir unless it is already there. Concurrent calls for the same path
+        wait for the copy that is in progress instead of starting another one."""
+        target_path = work_dir / _path
+        with self._copy_lock:
+            if os.path.exists(target_path):
+                return
+            pending = self._copying.get(_path)
+            if pending is None:
+                pending = _PendingLoad()
+                self._copying[_path] = pending
+                is_copier = True
+            else:
+                is_copier = False
+
+        if not is_copier:
+            pending.done.wait()
+            if pending.error:
+                raise pending.error
+            return
+
+        try:
+            os.makedirs(target_path.parent, exist_ok=True)
+            file = self._get_file_from_content(_path, os.O_RDONLY)
+            # Copy to a temporary file first so that an interrupted copy never shadows the original file.
+            temp_dir = work_dir / BotWContent.COPY_TEMP_DIR
+            os.makedirs(temp_dir, exist_ok=True)
+            temp_path = temp_dir / hashlib.sha1(str(_path).encode()).hexdigest()
+            temp_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | BINARY_MODE, 0o666)
+            try:
+                file.copy_to(temp_fd)
+            except BaseException:
+                os.close(temp_fd)
+                os.unlink(temp_path)
+                raise
+            os.close(temp_fd)
+            os.replace(temp_path, target_path)
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._copy_lock:
+                del self._copying[_path]
+            pending.done.set()
 
     def create(self, partial: str, mode, fi=None):
-        if not self.work_dir:
+        if not self.work_dir or self._is_control_path(self._path(partial)):
             raise FuseOSError(errno.EROFS)
+        # TODO: error if the parent dir does not exist
+        os.makedirs(self.work_dir / self._path(partial).parent, exist_ok=True)
+        file = HostFile(os.open(self.work_dir / self._path(partial), os.O_RDWR | os.O_CREAT | BINARY_MODE, mode))
+        self.stat_cache.invalidate(self._path(partial), False)
         with self.fd_lock:
-            # TODO: error if the parent dir does not exist
-            os.makedirs(self.work_dir / self._path(partial).parent, exist_ok=True)
-            return self.fd_map.allocate(
-                HostFile(os.open(self.work_dir / self._path(partial), os.O_RDWR | os.O_CREAT | BINARY_MODE, mode)))
+            return self.fd_map.allocate(file)
 
+    # No locking is needed here: files are read and written at explicit offsets
+    # and looking up an entry does not modify the fd map.
     def read(self, partial: str, length, offset, fd: int):
-        with self.fd_lock:
-            file = self.fd_map.get_entry(fd)
-            file.seek(offset)
-            return file.read(length)
+        return self.fd_map.get_entry(fd).pread(length, offset)
 
     def write(self, partial: str, buf, offset, fd: int):
-        with self.fd_lock:
-            file = self.fd_map.get_entry(fd)
-            file.seek(offset)
-            return file.write(buf)
+        return self.fd_map.get_entry(fd).pwrite(buf, offset)
 
     def truncate(self, partial: str, length, fh=None):
         _path = self._path(partial)
-        if not self.work_dir:
+        if _path == BotWContent.PROFILE_FILE and self.profiler:
+            # Writing to the control file with a shell redirection truncates it first.
+            return
+        if not self.work_dir or self._is_control_path(_path):
             raise FuseOSError(errno.EROFS)
         with open(self.work_dir / _path, 'r+b') as f:
             f.truncate(length)
@@ -450,17 +2119,40 @@ class BotWContent(Operations):
     def fsync(self, path, fdatasync, fd: int):
         return self.flush(path, fd)
 
+    def destroy(self, path):
+        if self.snapshot_path:
+            self.content_device.save_snapshot(self.snapshot_path)
+        if self.access_profile:
+            self.access_profile.save()
+        stats = self.archives.get_stats()
+        sys.stderr.write('archive cache: %d hits, %d misses, %d evictions\n' % (stats['hits'], stats['misses'], stats['evictions']))
+        sys.stderr.write('handles: %d still open (peak: %d)\n' % (len(self.fd_map), self.fd_map.peak_count))
+
 def _exit_if_not_dir(path: str):
     if not os.path.isdir(path):
         sys.stderr.write('error: %s is not a directory\n' % path)
         sys.exit(1)
 
-def main(content_dirs: typing.List[str], target_dir: str, work_dir: typing.Optional[str]) -> None:
+def main(content_dirs: typing.List[str], target_dir: str, work_dir: typing.Optional[str],
+         cache_dir: typing.Optional[str] = None, cache_size: int = 4096,
+         memory_limit: int = 2048, pinned_archives: typing.Collection[str] = (),
+         watch: bool = True, poll_interval: float = 5.0, warmup_jobs: int = 0,
+         snapshot_path: typing.Optional[str] = None, catalog_path: typing.Optional[str] = None,
+         profile_path: typing.Optional[str] = None, trace_path: typing.Optional[str] = None,
+         access_profile_path: typing.Optional[str] = None) -> None:
+    if FUSE is None:
+        sys.stderr.write('error: libfuse is not available\n')
+        sys.exit(1)
     for d in content_dirs:
         _exit_if_not_dir(d)
     if work_dir:
         _exit_if_not_dir(work_dir)
 
+    profiler = None
+    if profile_path:
+        profiler = Profiler(os.path.realpath(profile_path), PROFILE_STAGES, __file__)
+        install_profile_signal(profiler)
+
     content_dirs = [os.path.realpath(d) for d in content_dirs]
     target_dir = os.path.realpath(target_dir)
 
@@ -472,22 +2164,78 @@ def main(content_dirs: typing.List[str], target_dir: str, work_dir: typing.Optio
     else:
         print('work: (none, read-only)')
 
+    archive_cache = None
+    if cache_dir:
+        print('archive cache: %s (%d MiB)' % (cache_dir, cache_size))
+        archive_cache = DecompressedArchiveCache(cache_dir, cache_size * 1024 * 1024)
+
     content_device = ContentDevice([PPPath(d) for d in content_dirs])
+    if not snapshot_path or not content_device.load_snapshot(snapshot_path):
+        threading.Thread(target=content_device.layers.build, daemon=True).start()
+    operations = BotWContent(content_device, work_dir, archive_cache,
+                             max_archive_memory=memory_limit * 1024 * 1024, pinned_archives=pinned_archives,
+                             snapshot_path=snapshot_path,
+                             catalog=ArchiveCatalog(catalog_path) if catalog_path else None,
+                             profiler=profiler, tracer=TraceRecorder(trace_path) if trace_path else None,
+                             access_profile=AccessProfile(access_profile_path) if access_profile_path else None)
+
+    watchers: list = []
+    watcher_thread = None
+    if watch:
+        def on_change(root: typing.Optional[str], path: typing.Optional[PPPath], is_dir: bool) -> None:
+            operations.invalidate(path, is_dir, root != work_dir)
+        def start_watcher() -> None:
+            watcher = make_watcher(content_dirs + ([work_dir] if work_dir else []), on_change, poll_interval)
+            watcher.start()
+            watchers.append(watcher)
+        # Setting up the watches walks every directory, so do not delay the mount for it.
+        watcher_thread = threading.Thread(target=start_watcher, daemon=True)
+        watcher_thread.start()
+
+    if warmup_jobs > 0:
+        threading.Thread(target=operations.warm_up, args=(warmup_jobs,), daemon=True).start()
 
     if os.name != 'nt':
-        FUSE(BotWContent(content_device, work_dir), target_dir, foreground=True)
+        FUSE(operations, target_dir, foreground=True)
     else:
-        FUSE(BotWContent(content_device, work_dir), target_dir, foreground=True,
+        FUSE(operations, target_dir, foreground=True,
              uid=65792, gid=65792, umask=0)
 
+    if watcher_thread:
+        watcher_thread.join()
+    for watcher in watchers:
+        watcher.stop()
+    if operations.tracer:
+        operations.tracer.close()
+
 def cli_main() -> None:
     parser = argparse.ArgumentParser(description='Presents an extracted content view.')
     parser.add_argument('content_dirs', nargs='+', help='Path to the content directory.')
     parser.add_argument('target_mount_dir', help='Path to the directory on which the merged view should be mounted')
     parser.add_argument('-w', '--workdir', help='Path to the directory where modified/new files will be stored (in an extracted form). Assumed not to contain archives.')
+    parser.add_argument('--cache-dir', help='Path to a directory where decompressed archives will be cached across mounts')
+    parser.add_argument('--cache-size', type=int, default=4096, help='Maximum size of the archive cache directory in MiB (default: 4096)')
+    parser.add_argument('--memory-limit', type=int, default=2048, help='Maximum total size of archives that are kept in memory in MiB (default: 2048)')
+    parser.add_argument('--pin-archive', action='append', default=[], metavar='NAME', help='Name of an archive that should always be kept in memory, e.g. TitleBG.pack. Can be passed several times.')
+
+    parser.add_argument('--no-watch', action='store_true', help='Do not watch the content and work directories for changes. Only use this if they are never modified while mounted.')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='Interval in seconds between checks for changes when inotify is unavailable (default: 5)')
+
+    parser.add_argument('--snapshot', metavar='FILE', help='Path to a file where the layer structure is saved on unmount and restored from on mount, for faster startup')
+    parser.add_argument('--catalog', metavar='FILE', help='Path to a database where archive file lists are stored, so that archives can be listed without reading them')
+    parser.add_argument('--profile', metavar='FILE', help='Path where profiles are written. Profiling is started and stopped with SIGUSR2 or by writing on/off to .botwfs/profile in the view')
+    parser.add_argument('--record-trace', metavar='FILE', help='Record every operation to FILE. The trace can be replayed with botw-replay-trace')
+    parser.add_argument('--access-profile', metavar='FILE', help='Path to a file where the order in which archives are read is saved, so that they can be loaded ahead of time on the next mount')
+    parser.add_argument('--warmup', type=int, default=0, metavar='JOBS', help='Load archives in the background with JOBS threads after mounting (default: 0, disabled)')
 
     args = parser.parse_args()
-    main(content_dirs=args.content_dirs, target_dir=args.target_mount_dir, work_dir=args.workdir)
+    main(content_dirs=args.content_dirs, target_dir=args.target_mount_dir, work_dir=args.workdir,
+         cache_dir=args.cache_dir, cache_size=args.cache_size,
+         memory_limit=args.memory_limit, pinned_archives=args.pin_archive,
+         watch=not args.no_watch, poll_interval=args.poll_interval, warmup_jobs=args.warmup,
+         snapshot_path=args.snapshot, catalog_path=args.catalog,
+         profile_path=args.profile, trace_path=args.record_trace,
+         access_profile_path=args.access_profile)
 
 if __name__ == '__main__':
     cli_main()
@@ -12,14 +12,23 @@ import sys
 import tempfile
 import typing
 
+def _module_command(module: str) -> typing.List[str]:
+    return [sys.executable, '-m', 'botwfstools.' + module]
+
+def _child_env() -> typing.Dict[str, str]:
+    """Makes the package importable by child processes, even if it is run from a checkout that is not installed."""
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(path for path in (package_parent, env.get('PYTHONPATH')) if path)
+    return env
+
 def _spawn(args):
     if os.name == 'nt':
-        return subprocess.Popen(args, stdout=subprocess.DEVNULL, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
-    return subprocess.Popen(args, stdout=subprocess.DEVNULL, preexec_fn=os.setpgrp)
+        return subprocess.Popen(args, stdout=subprocess.DEVNULL, env=_child_env(),
+                                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    return subprocess.Popen(args, stdout=subprocess.DEVNULL, env=_child_env(), preexec_fn=os.setpgrp)
 
 def main(content_dir: typing.List[str], content_view: str, work_dir: str, patched_view: typing.Optional[str], target: str, patch_dir: typing.Optional[str]) -> None:
-    this_dir = os.path.dirname(os.path.abspath(__file__))
-
     if not patched_view and not patch_dir:
         sys.stderr.write('error: please pass --patched-view and/or --patch-dir, otherwise this tool cannot do much\n')
         sys.exit(1)
@@ -36,17 +45,17 @@ def main(content_dir: typing.List[str], content_view: str, work_dir: str, patche
             patch_dir = temp_patch_dir
 
         # Mount overlayfs: content_dirs... -> merged_dir
-        overlayfs_p1 = _spawn([sys.executable, os.path.join(this_dir, 'botw_overlayfs.py'),
+        overlayfs_p1 = _spawn([*_module_command('botw_overlayfs'),
                                *content_dir, temp_merged_dir])
         print(temp_merged_dir)
         # Mount contentfs: content_dirs... work_dir -> content_view (work: work_dir)
         # Note that we do not use the merged view to reduce overhead
-        contentfs_p = _spawn([sys.executable, os.path.join(this_dir, 'botw_contentfs.py'),
+        contentfs_p = _spawn([*_module_command('botw_contentfs'),
                               *content_dir, content_view, '-w', work_dir])
         overlayfs_p2 = None
         if patched_view:
             # Mount overlayfs: content_dirs... patch_dir -> patched_view (work: patch_dir)
-            overlayfs_p2 = _spawn([sys.executable, os.path.join(this_dir, 'botw_overlayfs.py'),
+            overlayfs_p2 = _spawn([*_module_command('botw_overlayfs'),
                                    *content_dir, patched_view, '-w', patch_dir])
 
         def signal_handler(sig, frame):
@@ -68,8 +77,8 @@ def main(content_dir: typing.List[str], content_view: str, work_dir: str, patche
             sys.stderr.write('\n')
             sys.stderr.write(f'{Style.DIM}--------------- Running patcher ---------------{Style.RESET_ALL}\n')
             try:
-                subprocess.run([sys.executable, os.path.join(this_dir, 'botw_patcher.py'), temp_merged_dir,
-                               work_dir, patch_dir, '--force', '--target', target], check=True)
+                subprocess.run([*_module_command('botw_patcher'), temp_merged_dir,
+                               work_dir, patch_dir, '--force', '--target', target], check=True, env=_child_env())
             except subprocess.CalledProcessError:
                 sys.stderr.write(f'{Style.BRIGHT}{Fore.RED}Patcher exited with non-zero code{Style.RESET_ALL}\n')
                 signal_handler(None, None)
@@ -3,42 +3,246 @@
 # Licensed under MIT
 
 import argparse
+from collections import OrderedDict
 import errno
+import itertools
+import mmap
 import os
 from pathlib import Path
 import shutil
+import struct
 import sys
+import threading
+import time
 import typing
 
-from fuse import FUSE, FuseOSError, Operations # type: ignore
+from botwfstools.fsutil import (BINARY_MODE, FUSE, FuseOSError, Operations, Profiler, TraceRecorder,
+                                copy_file_data, install_profile_signal, my_stat, pack_str)
 
-BINARY_MODE = os.O_BINARY if os.name == 'nt' else 0
+PROFILE_STAGES = {
+    'path resolution': ('_real_path',),
+    'stat': ('<built-in method posix.lstat>', '<built-in method posix.stat>', '<built-in method nt.lstat>',
+             '<built-in method nt.stat>', "<method 'stat' of 'posix.DirEntry' objects>",
+             "<method 'stat' of 'nt.DirEntry' objects>"),
+    'file I/O': ('<built-in method posix.read>', '<built-in method posix.write>', '<built-in method nt.read>',
+                 '<built-in method nt.write>'),
+}
 
 class BotWMergedContent(Operations):
     """Similar to overlayfs. More assumptions but simpler and should work on Windows."""
 
-    def __init__(self, content_dir: typing.List[str], work_dir: typing.Optional[str]) -> None:
+    def __init__(self, content_dir: typing.List[str], work_dir: typing.Optional[str],
+                 snapshot_path: typing.Optional[str] = None,
+                 profiler: typing.Optional[Profiler] = None,
+                 tracer: typing.Optional[TraceRecorder] = None) -> None:
         self.content_dir = content_dir
+        self.profiler = profiler
+        self.tracer = tracer
         self.work_dir = work_dir
-        self.path_cache: typing.Dict[str, str] = dict()
-        self.stat_cache: typing.Dict[str, dict] = dict()
-        self.readdir_cache: typing.Dict[str, set] = dict()
+        self.snapshot_path = snapshot_path
+        # Operations run on several threads. Cache lookups are single dict operations, which are atomic,
+        # so only updates take the lock. Recency is only refreshed for a sample of hits (see _cache_get).
+        self._cache_lock = threading.Lock()
+        self._cache_hits = itertools.count()
+        # Incremented on every invalidation so that values computed concurrently are not stored.
+        self._generation = 0
+        # Held while a file is copied to the work dir so that it is only copied once.
+        self._copy_lock = threading.Lock()
+        # The work dir can be written to by other processes (e.g. the patcher), so these caches
+        # only ever contain paths that were resolved to a content dir.
+        self.path_cache: typing.Dict[str, str] = OrderedDict()
+        self.stat_cache: typing.Dict[str, dict] = OrderedDict()
+        # Directory -> (mtime of the directory in each layer, entries sorted by name). Stats are None
+        # for entries in the work dir.
+        self.readdir_cache: typing.Dict[str, typing.Tuple[typing.List[int], typing.List[typing.Tuple[str, typing.Optional[dict]]]]] = OrderedDict()
+        self._readdir_cache_entries = 0
+        # Paths that were not found -> mtime of their parent in the work dir at that time.
+        self.missing_cache: typing.Dict[str, int] = OrderedDict()
+        if snapshot_path:
+            self.load_snapshot(snapshot_path)
+
+    _CACHE_SIZE = 2**16
+    # One in this many cache hits moves the entry to the end of the LRU order.
+    _RECENCY_SAMPLE = 16
+    # Maximum total number of entries in cached directory listings.
+    _READDIR_CACHE_SIZE = 2**16
+    _MISSING_CACHE_SIZE = 2**14
+
+    def __call__(self, op, *args):
+        if self.tracer is not None:
+            return self.tracer.call(op, self._dispatch, *args)
+        return self._dispatch(op, *args)
+
+    def _dispatch(self, op, *args):
+        if self.profiler is not None and self.profiler.active:
+            return self.profiler.call(op, super().__call__, op, *args)
+        return super().__call__(op, *args)
+
+    _SNAPSHOT_MAGIC = b'BFOS'
+    _SNAPSHOT_VERSION = 2
+
+    def _get_layers(self) -> typing.List[str]:
+        return self.content_dir + [self.work_dir or '']
+
+    def _get_dir_mtimes(self, partial_dir: str) -> typing.List[int]:
+        mtimes = []
+        for directory in self._get_layers():
+            try:
+                mtimes.append(os.stat(directory + partial_dir).st_mtime_ns if directory else -1)
+            except OSError:
+                mtimes.append(-1)
+        return mtimes
+
+    def save_snapshot(self, file_path: str) -> None:
+        """Saves the path cache along with the mtimes of the directories it depends on. Stats are not saved:
+        rewriting a file does not change the mtime of its directory, so they could not be validated."""
+        with self._cache_lock:
+            path_cache = dict(self.path_cache)
+        dirs = {str(Path(path).parent) for path in path_cache}
+        layers = self._get_layers()
+        parts = [self._SNAPSHOT_MAGIC, struct.pack('<II', self._SNAPSHOT_VERSION, len(layers))]
+        parts += [pack_str(layer) for layer in layers]
+        parts.append(struct.pack('<I', len(dirs)))
+        for partial_dir in dirs:
+            parts += [pack_str(partial_dir), struct.pack('<%dq' % len(layers), *self._get_dir_mtimes(partial_dir))]
+        parts.append(struct.pack('<I', len(path_cache)))
+        for path, real_path in path_cache.items():
+            parts += [pack_str(path), pack_str(real_path)]
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(b''.join(parts))
+        os.replace(temp_path, file_path)
+
+    def load_snapshot(self, file_path: str) -> bool:
+        """Restores the path cache from a snapshot. Entries in directories that have changed since
+        the snapshot was taken are skipped."""
+        try:
+            with open(file_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        with data:
+            offset = 0
+            def read(fmt: str) -> tuple:
+                nonlocal offset
+                values = struct.unpack_from(fmt, data, offset)
+                offset += struct.calcsize(fmt)
+                return values
+            def read_str() -> str:
+                nonlocal offset
+                size = read('<I')[0]
+                offset += size
+                return data[offset - size:offset].decode()
+
+            try:
+                if data[0:4] != self._SNAPSHOT_MAGIC:
+                    return False
+                offset = 4
+                version, layer_count = read('<II')
+                layers = self._get_layers()
+                if version != self._SNAPSHOT_VERSION or [read_str() for _ in range(layer_count)] != layers:
+                    return False
+                stale_dirs = set()
+                for _ in range(read('<I')[0]):
+                    partial_dir = read_str()
+                    if list(read('<%dq' % layer_count)) != self._get_dir_mtimes(partial_dir):
+                        stale_dirs.add(partial_dir)
+                for _ in range(read('<I')[0]):
+                    path = read_str()
+                    real_path = read_str()
+                    if str(Path(path).parent) not in stale_dirs:
+                        self.path_cache[path] = real_path
+            except (struct.error, UnicodeDecodeError):
+                self.path_cache.clear()
+                return False
+        while len(self.path_cache) > self._CACHE_SIZE:
+            self.path_cache.popitem(last=False) # type: ignore
+        return True
+
+    def destroy(self, path):
+        if self.snapshot_path:
+            self.save_snapshot(self.snapshot_path)
+
+    def _get_work_parent_mtime(self, partial: str) -> int:
+        try:
+            return os.stat(self.work_dir + os.path.dirname(partial)).st_mtime_ns # type: ignore
+        except OSError:
+            return -1
+
+    def _cache_get(self, cache: typing.Dict[str, typing.Any], partial: str) -> typing.Any:
+        value = cache.get(partial)
+        # Approximate LRU: entries that are used often are still refreshed often enough to stay cached,
+        # while most hits do not need the lock. next() on a count is atomic.
+        if value is not None and next(self._cache_hits) % self._RECENCY_SAMPLE == 0:
+            with self._cache_lock:
+                if partial in cache:
+                    cache.move_to_end(partial) # type: ignore
+        return value
+
+    def _cache_put(self, cache: typing.Dict[str, typing.Any], items: typing.Iterable[typing.Tuple[str, typing.Any]],
+                   generation: int) -> None:
+        with self._cache_lock:
+            if generation != self._generation:
+                return
+            for partial, value in items:
+                cache[partial] = value
+            while len(cache) > self._CACHE_SIZE:
+                cache.popitem(last=False) # type: ignore
+
+    def _invalidate(self, partial: str) -> None:
+        """Must be called after an operation changes a path. Entries in the work dir are never cached,
+        so only the path, its parent (whose timestamps change) and the misses under the path are dropped."""
+        parent = os.path.dirname(partial)
+        prefix = partial + '/'
+        with self._cache_lock:
+            self._generation += 1
+            for cache in (self.path_cache, self.stat_cache):
+                cache.pop(partial, None)
+                cache.pop(parent, None)
+            for directory in (partial, parent):
+                listing = self.readdir_cache.pop(directory, None)
+                if listing is not None:
+                    self._readdir_cache_entries -= len(listing[1])
+            self.missing_cache.pop(partial, None)
+            for path in [path for path in self.missing_cache if path.startswith(prefix)]:
+                del self.missing_cache[path]
 
     def _real_path(self, partial: str) -> str:
         """Get a host FS path based on the content dir list and the work directory.
         File precedence: work_dir, content_dir[n-1], ..., content_dir[0]
         """
-        if not self.work_dir and partial in self.path_cache:
-            return self.path_cache[partial]
+        missing_mtime = self.missing_cache.get(partial)
+        if missing_mtime is not None:
+            # The work dir can be written to by other processes (e.g. the patcher), so a miss
+            # is only trusted if the parent directory has not changed since.
+            if not self.work_dir or missing_mtime == self._get_work_parent_mtime(partial):
+                raise FuseOSError(errno.ENOENT)
+            with self._cache_lock:
+                self.missing_cache.pop(partial, None)
         if self.work_dir:
             path = self.work_dir + partial
             if os.path.exists(path):
                 return path
+        cached_path = self._cache_get(self.path_cache, partial)
+        if cached_path is not None:
+            return cached_path
+        generation = self._generation
         for directory in reversed(self.content_dir):
             path = directory + partial
             if os.path.exists(path):
-                self.path_cache[partial] = path
+                self._cache_put(self.path_cache, [(partial, path)], generation)
                 return path
+        if self.work_dir:
+            # Check again after getting the mtime in case the file was created in the meantime.
+            mtime = self._get_work_parent_mtime(partial)
+            if os.path.exists(self.work_dir + partial):
+                return self.work_dir + partial
+        else:
+            mtime = -1
+        with self._cache_lock:
+            self.missing_cache[partial] = mtime
+            if len(self.missing_cache) > self._MISSING_CACHE_SIZE:
+                self.missing_cache.popitem(last=False) # type: ignore
         raise FuseOSError(errno.ENOENT)
 
     def access(self, path, mode):
@@ -49,46 +253,90 @@ class BotWMergedContent(Operations):
             raise FuseOSError(errno.EACCES)
 
     def getattr(self, path, fh=None):
-        if not self.work_dir and path in self.stat_cache:
-            return self.stat_cache[path]
+        if self.work_dir:
+            try:
+                return my_stat(os.lstat(self.work_dir + path))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        cached_stat = self._cache_get(self.stat_cache, path)
+        if cached_stat is not None:
+            return cached_stat
+        generation = self._generation
         real_path = self._real_path(path)
-        st = os.lstat(real_path)
-        d = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-        if os.name != 'nt':
-            d['st_blocks'] = st.st_blocks
-        if not self.work_dir:
-            self.stat_cache[path] = d
+        d = my_stat(os.lstat(real_path))
+        if not self.work_dir or real_path != self.work_dir + path:
+            self._cache_put(self.stat_cache, [(path, d)], generation)
         return d
 
-    def readdir(self, path, fh) -> typing.Iterator[str]:
-        entries = set(['.', '..'])
-
-        if self.work_dir:
-            real_path = self.work_dir + path
-            if os.path.isdir(real_path):
-                entries.update(os.listdir(real_path))
-
-        for directory in reversed(self.content_dir):
-            real_path = directory + path
-            if os.path.isdir(real_path):
-                l = os.listdir(real_path)
-                entries.update(l)
-
-        for r in entries:
-            yield r
+    def _list_dir(self, path: str) -> typing.List[typing.Tuple[str, typing.Optional[dict]]]:
+        """Returns the merged entries of a directory sorted by name. Listings are cached for as long as
+        the directory has the same mtime in every layer."""
+        mtimes = self._get_dir_mtimes(path)
+        cached = self._cache_get(self.readdir_cache, path)
+        if cached is not None and cached[0] == mtimes:
+            return cached[1]
+
+        # Same precedence as _real_path: the first layer that has an entry provides its stats.
+        entries: typing.Dict[str, typing.Tuple[typing.Optional[str], dict]] = dict()
+        prefix = path if path.endswith('/') else path + '/'
+        generation = self._generation
+        layers = ([self.work_dir] if self.work_dir else []) + list(reversed(self.content_dir))
+        for directory in layers:
+            try:
+                with os.scandir(directory + path) as it:
+                    for entry in it:
+                        if entry.name not in entries:
+                            # Entries from the work dir are not cached.
+                            real_path = entry.path if directory is not self.work_dir else None
+                            entries[entry.name] = (real_path, my_stat(entry.stat(follow_symlinks=False)))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+        content_entries = [(prefix + name, real_path, st) for name, (real_path, st) in entries.items() if real_path]
+        self._cache_put(self.path_cache, [(partial, real_path) for partial, real_path, _ in content_entries], generation)
+        self._cache_put(self.stat_cache, [(partial, st) for partial, _, st in content_entries], generation)
+
+        # The stats of files in the work dir can change without the mtime of their directory changing.
+        listing = [(name, st if real_path else None) for name, (real_path, st) in sorted(entries.items())]
+        with self._cache_lock:
+            if generation == self._generation:
+                previous = self.readdir_cache.pop(path, None)
+                if previous is not None:
+                    self._readdir_cache_entries -= len(previous[1])
+                self.readdir_cache[path] = (mtimes, listing)
+                self._readdir_cache_entries += len(listing)
+                while self._readdir_cache_entries > self._READDIR_CACHE_SIZE and len(self.readdir_cache) > 1:
+                    _, (_, evicted) = self.readdir_cache.popitem(last=False) # type: ignore
+                    self._readdir_cache_entries -= len(evicted)
+        return listing
+
+    def readdir(self, path, fh) -> typing.Iterator[typing.Tuple[str, typing.Optional[dict], int]]:
+        # fusepy does not pass the offset the kernel asks for, so the whole listing is returned
+        # with an offset of 0 and libfuse buffers it.
+        prefix = path if path.endswith('/') else path + '/'
+        yield ('.', None, 0)
+        yield ('..', None, 0)
+        for name, st in self._list_dir(path):
+            if st is None:
+                try:
+                    st = my_stat(os.lstat(self.work_dir + prefix + name)) # type: ignore
+                except OSError:
+                    continue
+            yield (name, dict(st), 0)
 
     def rmdir(self, path):
         if not self.work_dir or not os.path.exists(self.work_dir + path):
             raise FuseOSError(errno.EROFS)
-        return os.rmdir(self.work_dir + path)
+        os.rmdir(self.work_dir + path)
+        self._invalidate(path)
 
     def mkdir(self, path, mode):
         if not self.work_dir:
             raise FuseOSError(errno.EROFS)
         # Check if the parent path exists -- an error will be raised if it doesn't
         self._real_path(str(Path(path).parent))
-        return os.makedirs(self.work_dir + path, mode)
+        os.makedirs(self.work_dir + path, mode)
+        self._invalidate(path)
 
     def statfs(self, path):
         real_path = self._real_path(path)
@@ -109,24 +357,38 @@ class BotWMergedContent(Operations):
     def unlink(self, path):
         if not self.work_dir or not os.path.exists(self.work_dir + path):
             raise FuseOSError(errno.EROFS)
-        return os.unlink(self.work_dir + path)
+        os.unlink(self.work_dir + path)
+        self._invalidate(path)
 
     def rename(self, old, new):
         if not self.work_dir or not os.path.exists(self.work_dir + old):
             raise FuseOSError(errno.EROFS)
-        return os.rename(self.work_dir + old, self.work_dir + new)
+        os.rename(self.work_dir + old, self.work_dir + new)
+        self._invalidate(old)
+        self._invalidate(new)
 
     def utimens(self, path, times=None):
-        return os.utime(self._real_path(path), times)
+        os.utime(self._real_path(path), times)
+        self._invalidate(path)
 
     def open(self, path, flags):
         real_path = self._real_path(path)
         if (flags & os.O_WRONLY or flags & os.O_RDWR):
             if not self.work_dir:
                 raise FuseOSError(errno.EROFS)
-            if not os.path.exists(self.work_dir + path):
-                os.makedirs(self.work_dir + str(Path(path).parent), exist_ok=True)
-                shutil.copyfile(real_path, self.work_dir + path)
+            with self._copy_lock:
+                if not os.path.exists(self.work_dir + path):
+                    os.makedirs(self.work_dir + str(Path(path).parent), exist_ok=True)
+                    src_fd = os.open(real_path, os.O_RDONLY | BINARY_MODE)
+                    try:
+                        dst_fd = os.open(self.work_dir + path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | BINARY_MODE, 0o666)
+                        try:
+                            copy_file_data(src_fd, dst_fd)
+                        finally:
+                            os.close(dst_fd)
+                    finally:
+                        os.close(src_fd)
+                    self._invalidate(path)
 
         return os.open(self._real_path(path), flags | BINARY_MODE)
 
@@ -137,21 +399,38 @@ class BotWMergedContent(Operations):
         # Check whether the parent path exists.
         self._real_path(parent_dir)
         os.makedirs(self.work_dir + parent_dir, exist_ok=True)
-        return os.open(self.work_dir + path, os.O_RDWR | os.O_CREAT | BINARY_MODE, mode)
+        fd = os.open(self.work_dir + path, os.O_RDWR | os.O_CREAT | BINARY_MODE, mode)
+        self._invalidate(path)
+        return fd
+
+    # Writes only go to files in the work dir, whose stats are never cached, so they do not invalidate anything.
+    if hasattr(os, 'pread'):
+        # Reads and writes at explicit offsets so that handles can be used from several threads at once.
+        def read(self, path, length, offset, fh):
+            return os.pread(fh, length, offset)
+
+        def write(self, path, buf, offset, fh):
+            return os.pwrite(fh, buf, offset)
+    else:
+        # Windows does not have pread/pwrite.
+        _seek_lock = threading.Lock()
 
-    def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        def read(self, path, length, offset, fh):
+            with self._seek_lock:
+                os.lseek(fh, offset, os.SEEK_SET)
+                return os.read(fh, length)
 
-    def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        def write(self, path, buf, offset, fh):
+            with self._seek_lock:
+                os.lseek(fh, offset, os.SEEK_SET)
+                return os.write(fh, buf)
 
     def truncate(self, path, length, fh=None):
         if not self.work_dir:
             raise FuseOSError(errno.EROFS)
         with open(self.work_dir + path, 'r+b') as f:
             f.truncate(length)
+        self._invalidate(path)
 
     def flush(self, path, fh):
         pass
@@ -167,12 +446,22 @@ def _exit_if_not_dir(path: str):
         sys.stderr.write('error: %s is not a directory\n' % path)
         sys.exit(1)
 
-def main(content_dir: typing.List[str], target_dir: str, work_dir: typing.Optional[str]) -> None:
+def main(content_dir: typing.List[str], target_dir: str, work_dir: typing.Optional[str],
+         snapshot_path: typing.Optional[str] = None, profile_path: typing.Optional[str] = None,
+         trace_path: typing.Optional[str] = None) -> None:
+    if FUSE is None:
+        sys.stderr.write('error: libfuse is not available\n')
+        sys.exit(1)
     for directory in content_dir:
         _exit_if_not_dir(directory)
     if work_dir:
         _exit_if_not_dir(work_dir)
 
+    profiler = None
+    if profile_path:
+        profiler = Profiler(os.path.realpath(profile_path), PROFILE_STAGES, __file__)
+        install_profile_signal(profiler)
+
     for directory in content_dir:
         print('content: %s' % directory)
     print('target: %s' % target_dir)
@@ -180,20 +469,29 @@ def main(content_dir: typing.List[str], target_dir: str, work_dir: typing.Option
         print('work: %s' % work_dir)
     else:
         print('work: (none, read-only)')
+    operations = BotWMergedContent(content_dir, work_dir, snapshot_path, profiler,
+                                   TraceRecorder(trace_path) if trace_path else None)
     if os.name != 'nt':
-        FUSE(BotWMergedContent(content_dir, work_dir), target_dir, nothreads=True, foreground=True)
+        FUSE(operations, target_dir, foreground=True)
     else:
-        FUSE(BotWMergedContent(content_dir, work_dir), target_dir, nothreads=True, foreground=True,
+        FUSE(operations, target_dir, foreground=True,
              uid=65792, gid=65792, umask=0)
+    if operations.tracer:
+        operations.tracer.close()
 
 def cli_main() -> None:
     parser = argparse.ArgumentParser(description='Presents a merged content view and transparently redirects modifications to another directory.')
     parser.add_argument('content_dir', nargs='+', help='Paths to content directories. Directories take precedence over the ones on their left.')
     parser.add_argument('target_mount_dir', help='Path to the directory on which the merged view should be mounted')
     parser.add_argument('-w', '--workdir', help='Path to the directory where modified/new files will be stored')
+    parser.add_argument('--snapshot', metavar='FILE', help='Path to a file where lookup caches are saved on unmount and restored from on mount, for faster startup')
+
+    parser.add_argument('--record-trace', metavar='FILE', help='Record every operation to FILE. The trace can be replayed with botw-replay-trace')
+    parser.add_argument('--profile', metavar='FILE', help='Path where profiles are written. Profiling is started and stopped with SIGUSR2')
 
     args = parser.parse_args()
-    main(content_dir=args.content_dir, target_dir=args.target_mount_dir, work_dir=args.workdir)
+    main(content_dir=args.content_dir, target_dir=args.target_mount_dir, work_dir=args.workdir,
+         snapshot_path=args.snapshot, profile_path=args.profile, trace_path=args.record_trace)
 
 if __name__ == '__main__':
     cli_main()
@@ -229,7 +229,8 @@ def make_loadable_layer(content_dir: Path, patch_dir: Path, target_dir: Path, wi
     """
 
     # Copy files to the target directory so that we don't trash the original files.
-    shutil.copytree(str(patch_dir), str(target_dir))
+    # contentfs keeps partially copied files in .botwfs-tmp; they are not part of the patch.
+    shutil.copytree(str(patch_dir), str(target_dir), ignore=shutil.ignore_patterns('.botwfs-tmp'))
 
     # Build a list of files and directories that need to be patched.
     files_by_depth: typing.DefaultDict[int, typing.List[Path]] = defaultdict(list)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Copyright 2018 leoetlino <leo@leolam.fr>
+# Licensed under MIT
+
+import argparse
+from collections import defaultdict
+import json
+import os
+from pathlib import PurePosixPath as PPPath
+import time
+import typing
+
+from botwfstools import botw_contentfs, botw_overlayfs
+
+# Position of the handle in the arguments of operations that take one.
+HANDLE_ARGS = {
+    'getattr': 1, 'readdir': 1, 'releasedir': 1, 'fsyncdir': 2, 'read': 3, 'write': 3,
+    'truncate': 2, 'flush': 1, 'release': 1, 'fsync': 2,
+}
+
+def load_trace(file_path: str) -> typing.List[dict]:
+    with open(file_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def replay(operations, records: typing.Iterable[dict]) -> typing.Dict[str, list]:
+    """Calls the operations in a trace in order. Handles are translated to the ones returned during the replay
+    and data that is written is replaced with zeroes. Returns op -> [count, total time, errno mismatches]."""
+    results: typing.Dict[str, list] = defaultdict(lambda: [0, 0.0, 0])
+    handles: typing.Dict[int, int] = dict()
+    for record in records:
+        op = record['op']
+        if op in ('init', 'destroy') or not hasattr(operations, op):
+            continue
+        args: typing.List[typing.Any] = [bytes(arg['bytes']) if isinstance(arg, dict) else arg for arg in record['args']]
+        position = HANDLE_ARGS.get(op)
+        if position is not None and position < len(args) and args[position] is not None:
+            if args[position] not in handles:
+                # The handle comes from an open that failed or that is not in the trace.
+                results[op][2] += 1
+                continue
+            args[position] = handles[args[position]]
+
+        error = 0
+        start = time.perf_counter()
+        try:
+            result = operations(op, *args)
+            if op == 'readdir':
+                list(result)
+        except OSError as e:
+            error = e.errno or 0
+        elapsed = time.perf_counter() - start
+
+        if not error and 'fh' in record:
+            handles[record['fh']] = result
+        if op in ('release', 'releasedir') and position is not None:
+            handles.pop(record['args'][position], None)
+        entry = results[op]
+        entry[0] += 1
+        entry[1] += elapsed
+        if error != record.get('errno', 0):
+            entry[2] += 1
+    return results
+
+def print_results(results: typing.Dict[str, list], total_time: float) -> None:
+    print('%-12s %10s %12s %12s %10s' % ('operation', 'calls', 'total (s)', 'avg (us)', 'mismatch'))
+    for op, (calls, elapsed, mismatches) in sorted(results.items(), key=lambda item: -item[1][1]):
+        print('%-12s %10d %12.6f %12.1f %10d' % (op, calls, elapsed, elapsed / calls * 1e6 if calls else 0, mismatches))
+    print('total: %.6f s' % total_time)
+
+def cli_main() -> None:
+    parser = argparse.ArgumentParser(description='Replays a trace that was recorded with --record-trace without mounting anything.')
+    parser.add_argument('fs', choices=['contentfs', 'overlayfs'], help='Filesystem the trace was recorded from')
+    parser.add_argument('trace', help='Path to the trace')
+    parser.add_argument('content_dirs', nargs='+', help='Paths to the content directories')
+    parser.add_argument('-w', '--workdir', help='Path to the work directory. Writes in the trace are replayed with zeroes, so use a scratch copy.')
+    parser.add_argument('--cache-dir', help='contentfs: path to the decompressed archive cache')
+    parser.add_argument('--cache-size', type=int, default=4096, help='contentfs: maximum size of the archive cache in MiB (default: 4096)')
+    parser.add_argument('--memory-limit', type=int, default=2048, help='contentfs: maximum size of archives kept in memory in MiB (default: 2048)')
+    parser.add_argument('--pin-archive', action='append', default=[], metavar='NAME', help='contentfs: name of an archive that should always be kept in memory')
+    parser.add_argument('--catalog', metavar='FILE', help='contentfs: path to the archive catalog')
+    parser.add_argument('--snapshot', metavar='FILE', help='Path to a snapshot to start from')
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    operations: typing.Any
+    if args.fs == 'contentfs':
+        content_dirs = [os.path.realpath(d) for d in args.content_dirs]
+        archive_cache = None
+        if args.cache_dir:
+            archive_cache = botw_contentfs.DecompressedArchiveCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        content_device = botw_contentfs.ContentDevice([PPPath(d) for d in content_dirs])
+        # Build the layer index before starting so that it does not count towards the replay time.
+        if not args.snapshot or not content_device.load_snapshot(args.snapshot):
+            content_device.layers.build()
+        operations = botw_contentfs.BotWContent(
+            content_device, args.workdir, archive_cache, max_archive_memory=args.memory_limit * 1024 * 1024,
+            pinned_archives=args.pin_archive,
+            catalog=botw_contentfs.ArchiveCatalog(args.catalog) if args.catalog else None)
+    else:
+        operations = botw_overlayfs.BotWMergedContent(args.content_dirs, args.workdir)
+        # Not passed to the constructor so that the snapshot is not overwritten at the end.
+        if args.snapshot:
+            operations.load_snapshot(args.snapshot)
+
+    start = time.perf_counter()
+    results = replay(operations, records)
+    total_time = time.perf_counter() - start
+    print_results(results, total_time)
+    operations('destroy', '/')
+
+if __name__ == '__main__':
+    cli_main()
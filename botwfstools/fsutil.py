@@ -0,0 +1,373 @@
+# Copyright 2018 leoetlino <leo@leolam.fr>
+# Licensed under MIT
+"""Code that is shared by contentfs and overlayfs."""
+
+import cProfile
+import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # type: ignore
+import json
+import os
+import pstats
+import signal
+import stat
+import struct
+import sys
+import threading
+import time
+import types
+import typing
+
+try:
+    from fuse import FUSE, FuseOSError, Operations # type: ignore
+except EnvironmentError:
+    # libfuse is not available. The filesystem cannot be mounted but the operations can still be
+    # called directly, e.g. to replay a trace.
+    FUSE = None
+    class FuseOSError(OSError): # type: ignore
+        def __init__(self, errno_: int) -> None:
+            super().__init__(errno_, os.strerror(errno_))
+    class Operations: # type: ignore
+        """Same defaults as fusepy's Operations."""
+        def __call__(self, op, *args):
+            if not hasattr(self, op):
+                raise FuseOSError(errno.EFAULT)
+            return getattr(self, op)(*args)
+
+        def access(self, path, amode):
+            return 0
+        bmap = None
+        def chmod(self, path, mode):
+            raise FuseOSError(errno.EROFS)
+        def chown(self, path, uid, gid):
+            raise FuseOSError(errno.EROFS)
+        def create(self, path, mode, fi=None):
+            raise FuseOSError(errno.EROFS)
+        def destroy(self, path):
+            pass
+        def flush(self, path, fh):
+            return 0
+        def fsync(self, path, datasync, fh):
+            return 0
+        def fsyncdir(self, path, datasync, fh):
+            return 0
+        def getattr(self, path, fh=None):
+            if path != '/':
+                raise FuseOSError(errno.ENOENT)
+            return dict(st_mode=(stat.S_IFDIR | 0o755), st_nlink=2)
+        def getxattr(self, path, name, position=0):
+            raise FuseOSError(errno.ENOTSUP)
+        def init(self, path):
+            pass
+        def ioctl(self, path, cmd, arg, fip, flags, data):
+            raise FuseOSError(errno.ENOTTY)
+        def link(self, target, source):
+            raise FuseOSError(errno.EROFS)
+        def listxattr(self, path):
+            return []
+        lock = None
+        def mkdir(self, path, mode):
+            raise FuseOSError(errno.EROFS)
+        def mknod(self, path, mode, dev):
+            raise FuseOSError(errno.EROFS)
+        def open(self, path, flags):
+            return 0
+        def opendir(self, path):
+            return 0
+        def read(self, path, size, offset, fh):
+            raise FuseOSError(errno.EIO)
+        def readdir(self, path, fh):
+            return ['.', '..']
+        def readlink(self, path):
+            raise FuseOSError(errno.ENOENT)
+        def release(self, path, fh):
+            return 0
+        def releasedir(self, path, fh):
+            return 0
+        def removexattr(self, path, name):
+            raise FuseOSError(errno.ENOTSUP)
+        def rename(self, old, new):
+            raise FuseOSError(errno.EROFS)
+        def rmdir(self, path):
+            raise FuseOSError(errno.EROFS)
+        def setxattr(self, path, name, value, options, position=0):
+            raise FuseOSError(errno.ENOTSUP)
+        def statfs(self, path):
+            return {}
+        def symlink(self, target, source):
+            raise FuseOSError(errno.EROFS)
+        def truncate(self, path, length, fh=None):
+            raise FuseOSError(errno.EROFS)
+        def unlink(self, path):
+            raise FuseOSError(errno.EROFS)
+        def utimens(self, path, times=None):
+            return 0
+        def write(self, path, data, offset, fh):
+            raise FuseOSError(errno.EROFS)
+
+BINARY_MODE = os.O_BINARY if os.name == 'nt' else 0
+
+def my_stat(st) -> dict:
+    d = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+             'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+    if os.name != 'nt':
+        d['st_blocks'] = st.st_blocks
+    return d
+
+def pack_str(string: str) -> bytes:
+    """Encodes a string for a snapshot file: u32 length followed by UTF-8 data."""
+    encoded = string.encode()
+    return struct.pack('<I', len(encoded)) + encoded
+
+# Linux ioctl that makes a file share the data of another one on filesystems that support it (btrfs, XFS).
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def copy_file_data(src_fd: int, dst_fd: int) -> None:
+    """Copies the contents of a file to an empty file without reading all of it into memory.
+    The data is cloned if possible, then copied by the kernel, then copied in chunks."""
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+    size = os.fstat(src_fd).st_size
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset) # type: ignore
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            # Not supported by the kernel or across these filesystems.
+            pass
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+# From Python 3.12 on, a profiler sees every thread and only one can be enabled at a time.
+_PROCESS_WIDE_PROFILING = sys.version_info >= (3, 12)
+
+class Profiler:
+    """Profiles filesystem operations between two calls to toggle(). Before Python 3.12, cProfile only
+    sees the thread it is enabled in, so every thread gets its own profile that is only enabled while
+    an operation runs. Nothing is profiled while it is off.
+
+    stages maps the name of each internal stage in reports to the functions that make it up.
+    Only functions from source_file and built-in functions (listed by the name cProfile gives them) are matched."""
+    def __init__(self, output_path: str, stages: typing.Dict[str, typing.Tuple[str, ...]], source_file: str) -> None:
+        self.output_path = output_path
+        self.stages = stages
+        self.source_file = os.path.basename(source_file)
+        self.active = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._session = 0
+        self._profiles: typing.List[cProfile.Profile] = []
+        # Operation -> [count, total time] for the current session.
+        self._ops: typing.Dict[str, list] = dict()
+        # Number of operations that are being profiled.
+        self._running = 0
+
+    def toggle(self) -> None:
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self) -> None:
+        with self._cond:
+            if self.active:
+                return
+            profiles = []
+            if _PROCESS_WIDE_PROFILING:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    sys.stderr.write('cannot start profiling: %s\n' % e)
+                    return
+                profiles.append(profile)
+            self._session += 1
+            self._profiles = profiles
+            self._ops = dict()
+            self.active = True
+        sys.stderr.write('profiling started\n')
+
+    def stop(self) -> None:
+        with self._cond:
+            if not self.active:
+                return
+            self.active = False
+            if _PROCESS_WIDE_PROFILING:
+                self._profiles[0].disable()
+            else:
+                # Profiles cannot be collected while they are enabled on another thread.
+                this_thread = 1 if getattr(self._local, 'running', False) else 0
+                self._cond.wait_for(lambda: self._running <= this_thread, timeout=10)
+            profiles = self._profiles
+            ops = self._ops
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # The profile has no data (it was never enabled or is still enabled on a stuck thread).
+                pass
+        if stats is None:
+            sys.stderr.write('profiling stopped: no operations were profiled\n')
+            return
+        stats.dump_stats(self.output_path)
+        with open(self.output_path + '.txt', 'w') as f:
+            self._write_report(ops, stats, f)
+        sys.stderr.write('profile written to %s\n' % self.output_path)
+
+    def call(self, op: str, fn: typing.Callable, *args):
+        local = self._local
+        profile: typing.Optional[cProfile.Profile] = None
+        with self._cond:
+            active = self.active
+            if active:
+                if not _PROCESS_WIDE_PROFILING:
+                    if getattr(local, 'session', None) != self._session:
+                        local.session = self._session
+                        local.profile = cProfile.Profile()
+                        self._profiles.append(local.profile)
+                    profile = local.profile
+                self._running += 1
+        if not active:
+            return fn(*args)
+
+        local.running = True
+        start = time.perf_counter()
+        try:
+            if profile is not None:
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Another profiler is active. Only the time of the operation is recorded.
+                    profile = None
+            try:
+                result = fn(*args)
+                if isinstance(result, types.GeneratorType):
+                    # Generators do their work when they are iterated.
+                    result = list(result)
+                return result
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            elapsed = time.perf_counter() - start
+            local.running = False
+            with self._cond:
+                entry = self._ops.setdefault(op, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                self._running -= 1
+                self._cond.notify_all()
+
+    def _write_report(self, ops: typing.Dict[str, list], stats: pstats.Stats, f: typing.TextIO) -> None:
+        entries = stats.stats # type: ignore
+        def is_in(key: tuple, names: typing.Collection[str]) -> bool:
+            return key[2] in names and (key[0] == '~' or os.path.basename(key[0]) == self.source_file)
+
+        f.write('Time by operation (seconds):\n')
+        for op, (calls, total) in sorted(ops.items(), key=lambda item: -item[1][1]):
+            f.write('  %-20s %10d calls %12.6f\n' % (op, calls, total))
+
+        f.write('\nTime by stage (seconds, cumulative; a stage includes the time of the stages it calls):\n')
+        for stage, names in self.stages.items():
+            calls = 0
+            cumulative = 0.0
+            for key, (_, _, _, _, callers) in entries.items():
+                if not is_in(key, names):
+                    continue
+                # Only count calls from outside the stage so that nested calls are not counted twice.
+                for caller, (_, caller_calls, _, caller_cumulative) in callers.items():
+                    if not is_in(caller, names):
+                        calls += caller_calls
+                        cumulative += caller_cumulative
+            f.write('  %-20s %10d calls %12.6f\n' % (stage, calls, cumulative))
+
+        f.write('\n')
+        stats.stream = f # type: ignore
+        stats.sort_stats('cumulative').print_stats(50)
+
+def install_profile_signal(profiler: Profiler) -> None:
+    """Makes SIGUSR2 toggle the profiler. Python signal handlers only run on the main thread,
+    which is blocked in FUSE, so the signal is blocked and waited for on another thread instead.
+    Must be called before any other thread is started so that they all block the signal."""
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR2})
+    def wait() -> None:
+        while True:
+            signal.sigwait({signal.SIGUSR2})
+            profiler.toggle()
+    threading.Thread(target=wait, daemon=True).start()
+
+class TraceRecorder:
+    """Writes one line of JSON per operation with its arguments, thread, start time (relative to the
+    start of the trace), duration, and errno if it failed. Data buffers are only recorded by size."""
+    def __init__(self, file_path: str) -> None:
+        self._file = open(file_path, 'w')
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @staticmethod
+    def _to_json(arg):
+        if isinstance(arg, (bytes, bytearray, memoryview)):
+            return {'bytes': len(arg)}
+        if isinstance(arg, tuple):
+            return list(arg)
+        return arg
+
+    def call(self, op: str, fn: typing.Callable, *args):
+        """Calls fn(op, *args) and records the call."""
+        start = time.perf_counter()
+        result = None
+        error = 0
+        try:
+            result = fn(op, *args)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+        except OSError as e:
+            error = e.errno or errno.EIO
+            raise
+        except BaseException:
+            error = errno.EIO
+            raise
+        finally:
+            end = time.perf_counter()
+            record = {'t': round(start - self._start, 6), 'dt': round(end - start, 6), 'thread': threading.get_ident(),
+                      'op': op, 'args': [self._to_json(arg) for arg in args]}
+            if error:
+                record['errno'] = error
+            elif op in ('open', 'create', 'opendir'):
+                # Needed to match handles in later operations.
+                record['fh'] = result
+            elif op == 'read':
+                record['size'] = len(result) # type: ignore
+            line = json.dumps(record) + '\n'
+            with self._lock:
+                if not self._file.closed:
+                    self._file.write(line)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
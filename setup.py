@@ -30,6 +30,7 @@ setuptools.setup(
             'botw-overlayfs = botwfstools.botw_overlayfs:cli_main',
             'botw-edit = botwfstools.botw_edit:cli_main',
             'botw-patcher = botwfstools.botw_patcher:cli_main',
+            'botw-replay-trace = botwfstools.botw_replay:cli_main',
         ]
     },
 )
@@ -0,0 +1,40 @@
+import os
+from pathlib import PurePosixPath as PPPath
+import tempfile
+import unittest
+
+from botwfstools.botw_contentfs import LayerIndex
+
+class LayerIndexUpdateTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self._tmp.name, 'base')
+        os.makedirs(os.path.join(self.base, 'Dir'))
+        with open(os.path.join(self.base, 'Dir', 'a.txt'), 'w'):
+            pass
+        self.layers = LayerIndex([PPPath(self.base)])
+        self.layers.build(jobs=1)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    def test_update_path_that_was_never_indexed(self) -> None:
+        # Created and deleted before the event was handled (e.g. vim's 4913 probe).
+        self.layers.update(PPPath('Dir/4913'))
+        self.assertIsNone(self.layers.lookup(PPPath('Dir/4913')))
+        self.assertEqual(self.layers.list(PPPath('Dir')), {'a.txt'})
+
+        # Later updates still apply.
+        with open(os.path.join(self.base, 'Dir', 'later.txt'), 'w'):
+            pass
+        self.layers.update(PPPath('Dir/later.txt'))
+        self.assertEqual(self.layers.list(PPPath('Dir')), {'a.txt', 'later.txt'})
+
+    def test_update_removed_path(self) -> None:
+        os.remove(os.path.join(self.base, 'Dir', 'a.txt'))
+        self.layers.update(PPPath('Dir/a.txt'))
+        self.assertIsNone(self.layers.lookup(PPPath('Dir/a.txt')))
+        self.assertEqual(self.layers.list(PPPath('Dir')), set())
+
+if __name__ == '__main__':
+    unittest.main()